@@ -1,30 +1,23 @@
 
-import os, math, time
+import os, time
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-import pandas as pd
 from config import Config
+from services import catalog
 from services import csvio
 from services import notifications
-from services.filters import apply_filters
-from services.ml import predict_from_models
-
-def estimate_radius_km(magnitude: float) -> float:
-    # Visual-only radius; scales with magnitude
-    return max(5.0, 7.5 * (2 ** (float(magnitude) - 3)))
-
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    r = 6371.0
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    d_phi = math.radians(lat2 - lat1)
-    d_lambda = math.radians(lon2 - lon1)
-    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return r * c
+from services import alert_jobs
+from services import alert_pipeline
+from services.filters import filter_dataset, pair_datasets
+from services import ml
+from services import recompute
+from services import verification
 
 def create_app():
     csvio.ensure_storage()
     notifications.ensure_storage()
+    alert_jobs.start_workers()
+    alert_pipeline.start()
     app = Flask(__name__)
     app.config.from_object(Config)
     CORS(app)
@@ -33,72 +26,24 @@ def create_app():
     def health():
         return jsonify({"ok": True})
 
-    def load_detected_records():
-        df = csvio.read_api_earthquakes().copy()
-        df["time_ms"] = pd.to_datetime(df["time"], errors="coerce").astype("int64") // 10**6
-        df["radius_km"] = df["magnitude"].apply(lambda m: estimate_radius_km(m or 0))
-        records = df.to_dict(orient="records")
-        for record in records:
-            record["source"] = "detected"
-            record["id"] = record.get("id") or record.get("earthquake_id")
-            record["earthquake_id"] = record.get("earthquake_id") or record.get("id")
-        return records
-
-    def load_expected_records():
-        api_df = csvio.read_api_earthquakes()
-        pred_df = predict_from_models(api_df)
-        if pred_df is None:
-            pred_df = csvio.read_predictions().copy()
-        if "predicted_time" in pred_df.columns:
-            pred_df["predicted_time_ms"] = pd.to_datetime(pred_df["predicted_time"], errors="coerce").astype("int64") // 10**6
-        else:
-            pred_df["predicted_time_ms"] = 0
-        pred_df["radius_km"] = pred_df.get("predicted_magnitude", 0).apply(lambda m: estimate_radius_km(m or 0))
-        out = []
-        for _, row in pred_df.iterrows():
-            eq_id = row.get("earthquake_id") or row.get("id")
-            row_id = row.get("id") or (f"exp-{eq_id}" if eq_id else None)
-            payload = {
-                "id": row_id,
-                "earthquake_id": eq_id,
-                "latitude": row.get("predicted_latitude", row.get("latitude")),
-                "longitude": row.get("predicted_longitude", row.get("longitude")),
-                "original_latitude": row.get("latitude"),
-                "original_longitude": row.get("longitude"),
-                "depth": row.get("predicted_depth", row.get("depth")),
-                "magnitude": row.get("predicted_magnitude"),
-                "time": row.get("predicted_time"),
-                "time_ms": row.get("predicted_time_ms"),
-                "source": "expected",
-                "radius_km": row.get("radius_km", 10.0),
-                "place": None
-            }
-            if payload["id"] is None and payload["earthquake_id"]:
-                payload["id"] = f"exp-{payload['earthquake_id']}"
-            out.append(payload)
-        return out
+    @app.get("/api/models/status")
+    def models_status():
+        return jsonify(ml.model_status())
 
     @app.get("/api/earthquakes/detected")
     def detected():
-        records = load_detected_records()
         hidden = csvio.get_hidden_ids()
-        records.sort(key=lambda r: r.get("time_ms", 0), reverse=True)
-        records = apply_filters(records, request.args, hidden)
+        records = catalog.to_records(filter_dataset(catalog.detected_dataset(), request.args, hidden))
         return jsonify({"count": len(records), "items": records})
 
     @app.get("/api/earthquakes/expected")
     def expected():
-        out = load_expected_records()
         hidden = csvio.get_hidden_ids()
-        out.sort(key=lambda r: r.get("time_ms", 0), reverse=True)
-        out = apply_filters(out, request.args, hidden)
+        out = catalog.to_records(filter_dataset(catalog.expected_dataset(), request.args, hidden))
         return jsonify({"count": len(out), "items": out})
 
     @app.get("/api/earthquakes/pairs")
     def earthquake_pairs():
-        detected_records = load_detected_records()
-        expected_records = load_expected_records()
-
         def _get_float(param_name):
             value = request.args.get(param_name)
             if value is None:
@@ -117,95 +62,59 @@ def create_app():
             except (TypeError, ValueError):
                 return None
 
-        def _within_range(value, min_value, max_value):
-            if value is None:
-                return False
-            val = float(value)
-            if min_value is not None and val < min_value:
-                return False
-            if max_value is not None and val > max_value:
-                return False
-            return True
-
-        real_min_mag = _get_float("real_min_mag") or _get_float("min_mag")
-        real_max_mag = _get_float("real_max_mag") or _get_float("max_mag")
-        real_min_depth = _get_float("real_min_depth")
-        real_max_depth = _get_float("real_max_depth")
-
-        expected_min_mag = _get_float("expected_min_mag") or _get_float("min_mag")
-        expected_max_mag = _get_float("expected_max_mag") or _get_float("max_mag")
-        expected_min_depth = _get_float("expected_min_depth")
-        expected_max_depth = _get_float("expected_max_depth")
+        real_bounds = {
+            "min_mag": _get_float("real_min_mag") or _get_float("min_mag"),
+            "max_mag": _get_float("real_max_mag") or _get_float("max_mag"),
+            "min_depth": _get_float("real_min_depth"),
+            "max_depth": _get_float("real_max_depth"),
+        }
+        expected_bounds = {
+            "min_mag": _get_float("expected_min_mag") or _get_float("min_mag"),
+            "max_mag": _get_float("expected_max_mag") or _get_float("max_mag"),
+            "min_depth": _get_float("expected_min_depth"),
+            "max_depth": _get_float("expected_max_depth"),
+        }
 
         limit = _get_int("limit")
         hide_requested = request.args.get("hide", "1") == "1"
-        hidden_ids = csvio.get_hidden_ids()
-
-        real_lookup = {}
-        for record in detected_records:
-            key = record.get("earthquake_id") or record.get("id")
-            if key:
-                record["earthquake_id"] = key
-                real_lookup[key] = record
-
-        expected_lookup = {}
-        for record in expected_records:
-            key = record.get("earthquake_id")
-            if key:
-                expected_lookup[key] = record
-
-        pairs = []
-        for eq_id, real_record in real_lookup.items():
-            expected_record = expected_lookup.get(eq_id)
-            if expected_record is None:
-                continue
-
-            if hide_requested and (
-                real_record.get("id") in hidden_ids or expected_record.get("id") in hidden_ids
-            ):
-                continue
-
-            if not _within_range(real_record.get("magnitude"), real_min_mag, real_max_mag):
-                continue
-            if real_min_depth is not None or real_max_depth is not None:
-                if not _within_range(real_record.get("depth"), real_min_depth, real_max_depth):
-                    continue
-
-            if not _within_range(expected_record.get("magnitude"), expected_min_mag, expected_max_mag):
-                continue
-            if expected_min_depth is not None or expected_max_depth is not None:
-                if not _within_range(expected_record.get("depth"), expected_min_depth, expected_max_depth):
-                    continue
-
-            pairs.append({
-                "earthquake_id": eq_id,
-                "real": real_record,
-                "expected": expected_record
-            })
-
-        pairs.sort(
-            key=lambda item: max(
-                int(item["real"].get("time_ms") or 0),
-                int(item["expected"].get("time_ms") or 0)
-            ),
-            reverse=True
+        hidden_ids = csvio.get_hidden_ids() if hide_requested else set()
+
+        pairs = pair_datasets(
+            catalog.detected_dataset(),
+            catalog.expected_dataset(),
+            real_bounds,
+            expected_bounds,
+            hidden_ids,
+            limit=max(1, limit) if limit is not None else None,
         )
-
-        if limit is not None:
-            limit = max(1, limit)
-            pairs = pairs[:limit]
-
         return jsonify({"count": len(pairs), "items": pairs})
 
     @app.post("/api/earthquakes/expected/recompute")
     def expected_recompute():
-        api_df = csvio.read_api_earthquakes()
-        pred_df = predict_from_models(api_df)
-        if pred_df is None:
+        if not ml.models_ready():
             return jsonify({"ok": False, "error": "Models or scalers not found. Provide .h5 and .pkl in models/ or use existing predictions CSV."}), 400
-        # persist for auditability
-        path = csvio.write_predictions_out(pred_df)
-        return jsonify({"ok": True, "rows": len(pred_df), "path": path})
+        # runs in the background; a request while a job is running joins it
+        job, started = recompute.start()
+        return jsonify({"ok": True, "started": started, "job": job}), 202
+
+    @app.get("/api/earthquakes/expected/recompute")
+    def expected_recompute_latest():
+        job = recompute.latest_job()
+        if job is None:
+            return jsonify({"ok": False, "error": "No recompute job yet"}), 404
+        return jsonify({"ok": True, "job": job})
+
+    @app.get("/api/earthquakes/expected/recompute/<job_id>")
+    def expected_recompute_status(job_id):
+        job = recompute.job_status(job_id)
+        if job is None:
+            return jsonify({"ok": False, "error": "Job not found"}), 404
+        return jsonify({"ok": True, "job": job})
+
+    @app.get("/api/earthquakes/expected/accuracy")
+    def expected_accuracy():
+        # served predictions checked against the detected catalogue
+        return jsonify(verification.current_accuracy())
 
     @app.get("/api/earthquakes/summary")
     def summary():
@@ -316,22 +225,22 @@ def create_app():
         except notifications.NotificationSendError as exc:
             return jsonify({"ok": False, "error": str(exc)}), 500
 
-        return jsonify({"ok": True, "result": result})
+        pruned = notifications.prune_dead_tokens(result.get("responses", []))
+        return jsonify({"ok": True, "result": result, "pruned": pruned})
 
     @app.post("/api/alerts/notify/broadcast")
     def notify_broadcast():
         payload = request.get_json(force=True, silent=True) or {}
         tokens_payload = payload.get("tokens")
         if isinstance(tokens_payload, str):
-            tokens = [tokens_payload]
+            tokens, skipped = notifications.broadcast_targets([tokens_payload])
         elif isinstance(tokens_payload, list):
-            tokens = [str(token) for token in tokens_payload if token]
+            tokens, skipped = notifications.broadcast_targets(str(token) for token in tokens_payload if token)
         else:
-            tokens = notifications.list_tokens()
+            tokens, skipped = notifications.broadcast_targets()
 
-        tokens = [token for token in tokens if token]
         if not tokens:
-            return jsonify({"ok": False, "error": "No device tokens available"}), 404
+            return jsonify({"ok": False, "error": "No device tokens available", "skipped": skipped}), 404
 
         title = payload.get("title") or "QuakeScope Alert"
         body = payload.get("body") or ""
@@ -339,13 +248,21 @@ def create_app():
         dry_run = parse_bool(payload.get("dryRun"))
 
         try:
-            result = notifications.send_notification(tokens, title, body, data, dry_run=dry_run)
+            notifications.ensure_credentials()
+            job_id = alert_jobs.enqueue(tokens, title, body, data, dry_run=dry_run, kind="broadcast")
         except ValueError as exc:
             return jsonify({"ok": False, "error": str(exc)}), 400
         except notifications.NotificationSendError as exc:
             return jsonify({"ok": False, "error": str(exc)}), 500
 
-        return jsonify({"ok": True, "result": result})
+        return jsonify({"ok": True, "job": alert_jobs.job_status(job_id), "skipped": skipped}), 202
+
+    @app.get("/api/alerts/jobs/<job_id>")
+    def alert_job_status(job_id):
+        job = alert_jobs.job_status(job_id, include_items=parse_bool(request.args.get("items")))
+        if job is None:
+            return jsonify({"ok": False, "error": "Job not found"}), 404
+        return jsonify({"ok": True, "job": job})
 
     @app.post("/api/alerts/test-earthquake")
     def test_earthquake_alert():
@@ -361,41 +278,14 @@ def create_app():
         source = payload.get("source") or "simulated"
         dry_run = parse_bool(payload.get("dryRun"))
 
-        title = payload.get("title") or (
-            f"Simulated {source} earthquake" if source != "detected" else "Detected earthquake"
-        )
-        body = payload.get("body") or (
-            f"M{magnitude:.1f} event near ({latitude:.3f}, {longitude:.3f})."
+        default_title, default_body, data_payload = notifications.earthquake_alert(
+            earthquake_id, latitude, longitude, magnitude, depth_km, source
         )
+        title = payload.get("title") or default_title
+        body = payload.get("body") or default_body
 
-        entries = notifications.load_entries_snapshot()
-        matches = []
-        eligible_tokens = []
-        for token, entry in entries.items():
-            prefs = entry.get("preferences") or {}
-            pref_lat = prefs.get("latitude")
-            pref_lon = prefs.get("longitude")
-            radius_km = prefs.get("radius_km")
-            min_magnitude = prefs.get("minimum_magnitude", 0.0)
-
-            if pref_lat is None or pref_lon is None or radius_km is None:
-                continue
-            if magnitude < (min_magnitude or 0.0):
-                continue
-
-            distance_km = haversine_km(pref_lat, pref_lon, latitude, longitude)
-            if distance_km > radius_km:
-                continue
-            if notifications.has_received_alert(entry, earthquake_id):
-                continue
-
-            eligible_tokens.append(token)
-            matches.append({
-                "token": token,
-                "distance_km": distance_km,
-                "radius_km": radius_km,
-                "min_magnitude": min_magnitude,
-            })
+        matches = notifications.match_subscribers(latitude, longitude, magnitude, earthquake_id)
+        eligible_tokens = [match["token"] for match in matches]
 
         if not eligible_tokens:
             return jsonify({
@@ -413,15 +303,6 @@ def create_app():
                 "message": "No subscribers matched the simulated earthquake filters.",
             })
 
-        data_payload = {
-            "earthquake_id": earthquake_id,
-            "magnitude": f"{magnitude:.2f}",
-            "source": source,
-            "latitude": f"{latitude:.5f}",
-            "longitude": f"{longitude:.5f}",
-        }
-        if depth_km is not None:
-            data_payload["depth"] = f"{depth_km:.1f}"
         extra_data = payload.get("data")
         if isinstance(extra_data, dict):
             for key, value in extra_data.items():
@@ -430,24 +311,22 @@ def create_app():
                 data_payload[str(key)] = value
 
         try:
-            result = notifications.send_notification(
+            notifications.ensure_credentials()
+            job_id = alert_jobs.enqueue(
                 eligible_tokens,
                 title=title,
                 body=body,
                 data=data_payload,
                 dry_run=dry_run,
+                kind="earthquake",
+                earthquake_id=earthquake_id,
             )
         except notifications.NotificationSendError as exc:
             return jsonify({"ok": False, "error": str(exc)}), 500
 
-        if not dry_run:
-            for response in result.get("responses", []):
-                if response.get("success"):
-                    notifications.record_delivery(response.get("token"), earthquake_id)
-
         return jsonify({
             "ok": True,
-            "notified": result.get("success", 0),
+            "queued": len(eligible_tokens),
             "dry_run": dry_run,
             "earthquake": {
                 "id": earthquake_id,
@@ -458,8 +337,8 @@ def create_app():
                 "source": source,
             },
             "matches": matches,
-            "result": result,
-        })
+            "job": alert_jobs.job_status(job_id),
+        }), 202
 
     return app
 
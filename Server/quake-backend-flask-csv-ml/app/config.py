@@ -10,9 +10,33 @@ class Config:
     API_EARTHQUAKES_CSV = os.getenv("API_EARTHQUAKES_CSV", os.path.join(DATA_DIR, "api_earthquakes.csv"))
     PREDICTIONS_CSV = os.getenv("PREDICTIONS_CSV", os.path.join(DATA_DIR, "earthquake_predictions.csv"))
 
+    # Parse only rows appended to API_EARTHQUAKES_CSV since the last load (full reload if rewritten)
+    APPEND_AWARE_INGEST = os.getenv("APPEND_AWARE_INGEST", "true").lower() == "true"
+
+    # Storage backend for the catalogues: "csv" or "columnar" (memory-mapped NumPy
+    # tables produced by `python -m services.columnar` from the CSV files above)
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "csv").lower()
+    API_EARTHQUAKES_COLUMNAR_DIR = os.getenv("API_EARTHQUAKES_COLUMNAR_DIR", os.path.join(DATA_DIR, "columnar", "api_earthquakes"))
+    PREDICTIONS_COLUMNAR_DIR = os.getenv("PREDICTIONS_COLUMNAR_DIR", os.path.join(DATA_DIR, "columnar", "predictions"))
+
     # Output CSV (predictions produced by ML if recomputed)
     OUTPUT_PREDICTIONS_CSV = os.getenv("OUTPUT_PREDICTIONS_CSV", os.path.join(DATA_DIR, "predictions_out.csv"))
 
+    # Incremental prediction store: predict only new/changed events and upsert them here
+    INCREMENTAL_PREDICTIONS = os.getenv("INCREMENTAL_PREDICTIONS", "false").lower() == "true"
+    PREDICTIONS_STORE_CSV = os.getenv("PREDICTIONS_STORE_CSV", os.path.join(DATA_DIR, "predictions_store.csv"))
+    # Background recompute: input rows per inference chunk, and seconds without progress
+    # after which a running job is considered dead (its process exited)
+    RECOMPUTE_CHUNK_ROWS = int(os.getenv("RECOMPUTE_CHUNK_ROWS", "50000"))
+    RECOMPUTE_STALE_SECONDS = float(os.getenv("RECOMPUTE_STALE_SECONDS", "600"))
+    # Prediction verification: a prediction is correct when a detected event (other than the
+    # one it was predicted from) lies within all three tolerances of it
+    VERIFY_DISTANCE_KM = float(os.getenv("VERIFY_DISTANCE_KM", "100"))
+    VERIFY_TIME_TOLERANCE_HOURS = float(os.getenv("VERIFY_TIME_TOLERANCE_HOURS", "24"))
+    VERIFY_MAGNITUDE_TOLERANCE = float(os.getenv("VERIFY_MAGNITUDE_TOLERANCE", "0.5"))
+    # Candidate (prediction, event) pairs evaluated per vectorized block (bounds memory)
+    VERIFY_MAX_PAIRS = int(os.getenv("VERIFY_MAX_PAIRS", "2000000"))
+
     # Hidden IDs persistence
     HIDDEN_JSON  = os.getenv("HIDDEN_JSON", os.path.join(DATA_DIR, "hidden.json"))
 
@@ -20,16 +44,65 @@ class Config:
     DEFAULT_WINDOW_DAYS = int(os.getenv("DEFAULT_WINDOW_DAYS", "7"))
     DEFAULT_MIN_MAG = float(os.getenv("DEFAULT_MIN_MAG", "2.5"))
     MAX_LIMIT = int(os.getenv("MAX_LIMIT", "2000"))
+    # Cell size (degrees) of the spatial grid used for bbox / radius queries
+    SPATIAL_CELL_DEG = float(os.getenv("SPATIAL_CELL_DEG", "1.0"))
 
     # Models directory (h5 and pkl)
     MODELS_DIR = os.getenv("MODELS_DIR", os.path.join(os.path.dirname(__file__), "..", "models"))
+    # "h5" loads the Keras models; "tflite" serves the exports written by `python -m services.ml_export`
+    MODEL_FORMAT = os.getenv("MODEL_FORMAT", "h5").lower()
+    # How often (seconds) the model registry re-checks MODELS_DIR for changed files
+    MODELS_RELOAD_INTERVAL_SECONDS = float(os.getenv("MODELS_RELOAD_INTERVAL_SECONDS", "5"))
+    # Number of prediction results kept in memory (keyed by input + model versions)
+    PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "4"))
+    # Rows per compiled inference call (bounds activation memory on large inputs)
+    INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "8192"))
+    # Shared inference server (`python -m services.inference_server`): "host:port" or a
+    # Unix socket path. Empty = every worker loads and runs the models in-process.
+    INFERENCE_SERVER_ADDRESS = os.getenv("INFERENCE_SERVER_ADDRESS", "")
+    # Shared secret for the inference server; required by both sides (no default: the
+    # protocol unpickles messages, so the key is what keeps other local users out)
+    INFERENCE_SERVER_AUTHKEY = os.getenv("INFERENCE_SERVER_AUTHKEY", "")
+    # Seconds to wait for a reply, and to keep using in-process inference after a failure
+    INFERENCE_SERVER_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_SERVER_TIMEOUT_SECONDS", "30"))
+    INFERENCE_SERVER_RETRY_SECONDS = float(os.getenv("INFERENCE_SERVER_RETRY_SECONDS", "30"))
+    # Concurrent requests arriving within this window are run as one batch
+    INFERENCE_SERVER_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_SERVER_BATCH_WINDOW_MS", "2"))
 
     # Notification storage and delivery
+    # SQLite (WAL) database holding device tokens, preferences and delivery history
+    DEVICE_TOKENS_DB = os.getenv(
+        "DEVICE_TOKENS_DB",
+        os.path.join(DATA_DIR, "device_tokens.sqlite3")
+    )
+    # Legacy JSON token file; imported into DEVICE_TOKENS_DB once if present
     DEVICE_TOKENS_JSON = os.getenv(
         "DEVICE_TOKENS_JSON",
         os.path.join(DATA_DIR, "device_tokens.json")
     )
+    # Tokens not registered/updated for this many days are skipped by fan-out (0 = never)
+    TOKEN_STALE_DAYS = float(os.getenv("TOKEN_STALE_DAYS", "270"))
+    # Cell size (degrees) of the subscriber index used to match events to alert radii
+    ALERT_INDEX_CELL_DEG = float(os.getenv("ALERT_INDEX_CELL_DEG", "1.0"))
     FCM_SERVICE_ACCOUNT_JSON = os.getenv("FCM_SERVICE_ACCOUNT_JSON")
     FCM_PROJECT_ID = os.getenv("FCM_PROJECT_ID")
     FCM_API_URL = os.getenv("FCM_API_URL", "https://fcm.googleapis.com/v1")
+    # Static bearer token used instead of the service account (local FCM stand-in only)
+    FCM_ACCESS_TOKEN = os.getenv("FCM_ACCESS_TOKEN")
     FCM_TIMEOUT_SECONDS = float(os.getenv("FCM_TIMEOUT_SECONDS", "10"))
+    # Concurrent FCM requests per send (also the size of the keep-alive connection pool)
+    FCM_MAX_WORKERS = int(os.getenv("FCM_MAX_WORKERS", "16"))
+    # Background alert jobs: worker threads, tokens claimed per batch, and
+    # retry policy (exponential backoff) for 429/5xx/transport failures
+    ALERT_JOB_WORKERS = int(os.getenv("ALERT_JOB_WORKERS", "2"))
+    ALERT_JOB_BATCH_SIZE = int(os.getenv("ALERT_JOB_BATCH_SIZE", "500"))
+    ALERT_JOB_MAX_ATTEMPTS = int(os.getenv("ALERT_JOB_MAX_ATTEMPTS", "5"))
+    ALERT_JOB_BACKOFF_SECONDS = float(os.getenv("ALERT_JOB_BACKOFF_SECONDS", "2"))
+    ALERT_JOB_BACKOFF_MAX_SECONDS = float(os.getenv("ALERT_JOB_BACKOFF_MAX_SECONDS", "300"))
+    ALERT_JOB_POLL_SECONDS = float(os.getenv("ALERT_JOB_POLL_SECONDS", "1"))
+    # Automatic alerts for newly detected events: poll interval, how far behind the
+    # high-water mark late rows are still picked up, and the oldest event worth alerting
+    ALERT_PIPELINE_ENABLED = os.getenv("ALERT_PIPELINE_ENABLED", "false").lower() == "true"
+    ALERT_PIPELINE_POLL_SECONDS = float(os.getenv("ALERT_PIPELINE_POLL_SECONDS", "10"))
+    ALERT_PIPELINE_LOOKBACK_MINUTES = float(os.getenv("ALERT_PIPELINE_LOOKBACK_MINUTES", "60"))
+    ALERT_PIPELINE_MAX_EVENT_AGE_MINUTES = float(os.getenv("ALERT_PIPELINE_MAX_EVENT_AGE_MINUTES", "60"))
@@ -0,0 +1,364 @@
+"""Persisted background queue for alert fan-out.
+
+A job is one notification (title/body/data) addressed to a list of tokens.
+Jobs and their per-token items live in the device-token SQLite database,
+so queued work survives a restart. Worker threads claim due items under a
+lease, send them through notifications.deliver(), and retry 429/5xx and
+transport failures with exponential backoff until ALERT_JOB_MAX_ATTEMPTS.
+Tokens FCM reports as dead are deactivated as their responses come in.
+
+A lease covers one request's worst case (connect plus read timeout) and is
+renewed by a heartbeat while the claim is being sent, however many rounds
+of FCM_MAX_WORKERS requests it takes; items of a worker that died come back
+once their lease runs out.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from config import Config
+from . import notifications, token_store
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    title TEXT,
+    body TEXT,
+    data TEXT,
+    dry_run INTEGER NOT NULL DEFAULT 0,
+    earthquake_id TEXT,
+    total INTEGER NOT NULL DEFAULT 0,
+    pruned INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS alert_job_items (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    status_code INTEGER,
+    response TEXT,
+    PRIMARY KEY (job_id, token)
+);
+CREATE INDEX IF NOT EXISTS alert_job_items_due ON alert_job_items (status, next_attempt_at);
+"""
+
+# Item states: pending (due at next_attempt_at), sending (claimed until
+# lease_until; reclaimed if the worker died), sent, failed.
+PENDING, SENDING, SENT, FAILED = "pending", "sending", "sent", "failed"
+
+_LEASE_MARGIN_SECONDS = 30.0
+
+log = logging.getLogger(__name__)
+
+_init_lock = threading.Lock()
+_initialized: set = set()
+_wakeup = threading.Event()
+_workers: List[threading.Thread] = []
+_workers_lock = threading.Lock()
+
+
+def ensure_storage() -> None:
+    token_store.initialize()
+    path = Config.DEVICE_TOKENS_DB
+    with _init_lock:
+        if path in _initialized:
+            return
+        conn = token_store.connection()
+        conn.executescript(_SCHEMA)
+        token_store.add_missing_columns(conn, "alert_jobs", {"pruned": "INTEGER NOT NULL DEFAULT 0"})
+        _initialized.add(path)
+
+
+def _is_retryable(response: Dict[str, Any]) -> bool:
+    status = response.get("status_code")
+    return status is None or status == 429 or status >= 500
+
+
+def _backoff_seconds(attempts: int, response: Dict[str, Any]) -> float:
+    delay = Config.ALERT_JOB_BACKOFF_SECONDS * (2 ** max(0, attempts - 1))
+    try:
+        delay = max(delay, float(response.get("retry_after")))
+    except (TypeError, ValueError):
+        pass
+    return min(delay, Config.ALERT_JOB_BACKOFF_MAX_SECONDS)
+
+
+def enqueue(
+    tokens: Iterable[str],
+    title: str,
+    body: str,
+    data: Optional[Dict[str, Any]] = None,
+    dry_run: bool = False,
+    kind: str = "broadcast",
+    earthquake_id: Optional[str] = None,
+    txn: Optional[token_store.Transaction] = None,
+) -> str:
+    """Persist a job for tokens and wake the workers; returns the job id.
+
+    When earthquake_id is set (and not dry_run), successful sends are
+    recorded as deliveries so the same event is not alerted twice. Pass txn
+    to insert the job as part of a caller's transaction (the caller then
+    calls wake() after committing).
+    """
+    ensure_storage()
+    token_list = [token for token in dict.fromkeys(tokens) if token]
+    if not token_list:
+        raise ValueError("At least one token is required")
+
+    job_id = uuid.uuid4().hex
+    if txn is not None:
+        _insert_job(txn.conn, job_id, token_list, title, body, data, dry_run, kind, earthquake_id)
+        return job_id
+    with token_store.write_transaction() as own:
+        _insert_job(own.conn, job_id, token_list, title, body, data, dry_run, kind, earthquake_id)
+    wake()
+    return job_id
+
+
+def _insert_job(conn, job_id, token_list, title, body, data, dry_run, kind, earthquake_id) -> None:
+    now = time.time()
+    conn.execute(
+        "INSERT INTO alert_jobs (id, kind, status, title, body, data, dry_run, earthquake_id, total, created_at, updated_at) "
+        "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, kind, title, body, json.dumps(data or {}, ensure_ascii=False),
+         1 if dry_run else 0, earthquake_id, len(token_list), now, now),
+    )
+    conn.executemany(
+        "INSERT INTO alert_job_items (job_id, position, token, status, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+        [(job_id, position, token, PENDING, now) for position, token in enumerate(token_list)],
+    )
+
+
+def wake() -> None:
+    """Tell idle workers there is new work (instead of waiting for the next poll)."""
+    _wakeup.set()
+
+
+def _lease_seconds() -> float:
+    return 2 * Config.FCM_TIMEOUT_SECONDS + _LEASE_MARGIN_SECONDS
+
+
+@contextmanager
+def _leased(job_id: str, tokens: List[str]) -> Iterator[None]:
+    """Keep renewing the lease of the claimed tokens until the block exits."""
+    stop = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop.wait(_lease_seconds() / 3):
+            lease = time.time() + _lease_seconds()
+            try:
+                with token_store.write_transaction() as txn:
+                    txn.conn.executemany(
+                        "UPDATE alert_job_items SET lease_until = ? WHERE job_id = ? AND token = ? AND status = ?",
+                        [(lease, job_id, token, SENDING) for token in tokens],
+                    )
+            except Exception:
+                log.exception("renewing the lease of alert job %s failed", job_id)
+
+    thread = threading.Thread(target=heartbeat, name=f"alert-lease-{job_id[:8]}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _claim(limit: int) -> Optional[Dict[str, Any]]:
+    """Claim up to limit due items of the oldest job that has any."""
+    now = time.time()
+    with token_store.write_transaction() as txn:
+        conn = txn.conn
+        row = conn.execute(
+            "SELECT job_id FROM alert_job_items "
+            "WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until < ?) "
+            "ORDER BY next_attempt_at LIMIT 1",
+            (PENDING, now, SENDING, now),
+        ).fetchone()
+        if row is None:
+            return None
+        job = conn.execute("SELECT * FROM alert_jobs WHERE id = ?", (row["job_id"],)).fetchone()
+        items = conn.execute(
+            "SELECT token, attempts FROM alert_job_items "
+            "WHERE job_id = ? AND ((status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until < ?)) "
+            "ORDER BY position LIMIT ?",
+            (job["id"], PENDING, now, SENDING, now, limit),
+        ).fetchall()
+        lease = now + _lease_seconds()
+        conn.executemany(
+            "UPDATE alert_job_items SET status = ?, lease_until = ? WHERE job_id = ? AND token = ?",
+            [(SENDING, lease, job["id"], item["token"]) for item in items],
+        )
+        conn.execute(
+            "UPDATE alert_jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (now, job["id"]),
+        )
+    return {
+        "job": dict(job),
+        "attempts": {item["token"]: item["attempts"] for item in items},
+    }
+
+
+def _finish_if_done(conn, job_id: str, now: float) -> None:
+    open_items = conn.execute(
+        "SELECT COUNT(*) AS n FROM alert_job_items WHERE job_id = ? AND status IN (?, ?)",
+        (job_id, PENDING, SENDING),
+    ).fetchone()["n"]
+    if open_items == 0:
+        conn.execute(
+            "UPDATE alert_jobs SET status = 'done', updated_at = ?, finished_at = ? WHERE id = ?",
+            (now, now, job_id),
+        )
+    else:
+        conn.execute("UPDATE alert_jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+
+
+def _store_results(job: Dict[str, Any], attempts: Dict[str, int], responses: List[Dict[str, Any]]) -> List[str]:
+    now = time.time()
+    sent: List[str] = []
+    updates = []
+    for response in responses:
+        token = response["token"]
+        tries = attempts.get(token, 0) + 1
+        if response.get("success"):
+            status, next_at = SENT, now
+            sent.append(token)
+        elif _is_retryable(response) and tries < Config.ALERT_JOB_MAX_ATTEMPTS:
+            status, next_at = PENDING, now + _backoff_seconds(tries, response)
+        else:
+            status, next_at = FAILED, now
+        updates.append((
+            status, tries, next_at, response.get("status_code"),
+            json.dumps(response.get("response"), ensure_ascii=False), job["id"], token,
+        ))
+    with token_store.write_transaction() as txn:
+        txn.conn.executemany(
+            "UPDATE alert_job_items SET status = ?, attempts = ?, next_attempt_at = ?, lease_until = NULL, "
+            "status_code = ?, response = ? WHERE job_id = ? AND token = ?",
+            updates,
+        )
+        _finish_if_done(txn.conn, job["id"], now)
+    return sent
+
+
+def _fail_claimed(job: Dict[str, Any], tokens: Iterable[str], error: str) -> None:
+    """Credentials/configuration errors: nothing to retry, fail the items."""
+    now = time.time()
+    with token_store.write_transaction() as txn:
+        txn.conn.executemany(
+            "UPDATE alert_job_items SET status = ?, lease_until = NULL, response = ? WHERE job_id = ? AND token = ?",
+            [(FAILED, json.dumps({"error": error}), job["id"], token) for token in tokens],
+        )
+        txn.conn.execute("UPDATE alert_jobs SET error = ? WHERE id = ?", (error, job["id"]))
+        _finish_if_done(txn.conn, job["id"], now)
+
+
+def process_once(limit: Optional[int] = None) -> int:
+    """Claim and send one batch of due items; returns how many were sent."""
+    ensure_storage()
+    claimed = _claim(limit or Config.ALERT_JOB_BATCH_SIZE)
+    if claimed is None:
+        return 0
+    job, attempts = claimed["job"], claimed["attempts"]
+    try:
+        with _leased(job["id"], list(attempts)):
+            responses = notifications.deliver(
+                list(attempts),
+                job["title"] or "",
+                job["body"] or "",
+                json.loads(job["data"] or "{}"),
+                dry_run=bool(job["dry_run"]),
+            )
+    except notifications.NotificationSendError as exc:
+        _fail_claimed(job, attempts, str(exc))
+        return len(attempts)
+    sent = _store_results(job, attempts, responses)
+    pruned = notifications.prune_dead_tokens(responses)
+    if pruned:
+        with token_store.write_transaction() as txn:
+            txn.conn.execute(
+                "UPDATE alert_jobs SET pruned = pruned + ? WHERE id = ?", (len(pruned), job["id"])
+            )
+    if sent and job["earthquake_id"] and not job["dry_run"]:
+        notifications.record_deliveries((token, job["earthquake_id"]) for token in sent)
+    return len(responses)
+
+
+def _worker_loop() -> None:
+    while True:
+        try:
+            if process_once():
+                continue
+        except Exception:  # keep the worker alive; the lease will hand items back
+            log.exception("alert job worker error")
+        _wakeup.wait(Config.ALERT_JOB_POLL_SECONDS)
+        _wakeup.clear()
+
+
+def start_workers(count: Optional[int] = None) -> None:
+    """Start the background workers once per process (no-op if count <= 0)."""
+    count = Config.ALERT_JOB_WORKERS if count is None else count
+    ensure_storage()
+    with _workers_lock:
+        while len(_workers) < count:
+            worker = threading.Thread(
+                target=_worker_loop, name=f"alert-jobs-{len(_workers)}", daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+
+
+def job_status(job_id: str, include_items: bool = False) -> Optional[Dict[str, Any]]:
+    ensure_storage()
+    conn = token_store.connection()
+    job = conn.execute("SELECT * FROM alert_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return None
+    counts = {PENDING: 0, SENDING: 0, SENT: 0, FAILED: 0}
+    for row in conn.execute(
+        "SELECT status, COUNT(*) AS n FROM alert_job_items WHERE job_id = ? GROUP BY status", (job_id,)
+    ):
+        counts[row["status"]] = row["n"]
+    status = {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "dry_run": bool(job["dry_run"]),
+        "earthquake_id": job["earthquake_id"],
+        "total": job["total"],
+        "sent": counts[SENT],
+        "failed": counts[FAILED],
+        "pending": counts[PENDING] + counts[SENDING],
+        "pruned": job["pruned"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "finished_at": job["finished_at"],
+    }
+    if include_items:
+        status["items"] = [
+            {
+                "token": row["token"],
+                "status": row["status"],
+                "attempts": row["attempts"],
+                "status_code": row["status_code"],
+                "response": json.loads(row["response"]) if row["response"] else None,
+            }
+            for row in conn.execute(
+                "SELECT * FROM alert_job_items WHERE job_id = ? ORDER BY position", (job_id,)
+            )
+        ]
+    return status
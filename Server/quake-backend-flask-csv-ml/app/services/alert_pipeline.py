@@ -0,0 +1,188 @@
+"""Alerts for newly detected earthquakes.
+
+A background thread watches the detected catalogue (api_earthquakes.csv)
+and, whenever its version changes, looks only at events newer than a
+persisted high-water mark (minus a short lookback for late rows), matches
+each unseen one against the subscriber index and enqueues an alert job.
+
+Seen event ids, the jobs and the new high-water mark are committed in one
+transaction, so a restart neither re-scans the catalogue nor re-alerts, and
+two processes racing on the same event cannot both enqueue it (the second
+commit fails on the primary key). The first run only records the current
+newest event time, it does not alert on the existing catalogue.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config import Config
+from . import alert_jobs, catalog, csvio, notifications, token_store
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_pipeline_events (
+    earthquake_id TEXT PRIMARY KEY,
+    time_ms INTEGER NOT NULL,
+    job_id TEXT,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alert_pipeline_events_time ON alert_pipeline_events (time_ms);
+"""
+_HWM_KEY = "alert_pipeline_hwm_ms"
+
+log = logging.getLogger(__name__)
+
+_init_lock = threading.Lock()
+_initialized: set = set()
+_run_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+_last_version: Optional[int] = None
+
+
+def ensure_storage() -> None:
+    alert_jobs.ensure_storage()
+    path = Config.DEVICE_TOKENS_DB
+    with _init_lock:
+        if path in _initialized:
+            return
+        token_store.connection().executescript(_SCHEMA)
+        _initialized.add(path)
+
+
+def high_water_mark() -> Optional[int]:
+    ensure_storage()
+    row = token_store.connection().execute(
+        "SELECT value FROM meta WHERE key = ?", (_HWM_KEY,)
+    ).fetchone()
+    return None if row is None else int(row["value"])
+
+
+def _set_high_water_mark(conn: sqlite3.Connection, value: int) -> None:
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+        (_HWM_KEY, int(value)),
+    )
+
+
+def process_new_events(dataset: Optional[catalog.Dataset] = None) -> Dict[str, Any]:
+    """Enqueue alerts for detected events not seen before; returns a summary."""
+    ensure_storage()
+    with _run_lock:
+        dataset = dataset if dataset is not None else catalog.detected_dataset()
+        newest = int(dataset.time_ms[0]) if len(dataset) else None
+        hwm = high_water_mark()
+        lookback_ms = int(Config.ALERT_PIPELINE_LOOKBACK_MINUTES * 60_000)
+        if hwm is None:
+            # mark what is already in the lookback window as seen, without alerting
+            start, stop = dataset.time_window(since_ms=(newest or 0) - lookback_ms)
+            ids = dataset.frame["earthquake_id"].iloc[start:stop].astype(str)
+            now = time.time()
+            with token_store.write_transaction() as txn:
+                txn.conn.executemany(
+                    "INSERT OR IGNORE INTO alert_pipeline_events (earthquake_id, time_ms, job_id, processed_at) "
+                    "VALUES (?, ?, NULL, ?)",
+                    [(eq_id, int(t), now) for eq_id, t in zip(ids, dataset.time_ms[start:stop])],
+                )
+                _set_high_water_mark(txn.conn, newest if newest is not None else 0)
+            return {"initialized": True, "high_water_mark": newest, "events": 0, "jobs": 0}
+
+        since = hwm - lookback_ms
+        start, stop = dataset.time_window(since_ms=since)
+        if start == stop:
+            return {"initialized": False, "high_water_mark": hwm, "events": 0, "jobs": 0}
+
+        conn = token_store.connection()
+        seen = {
+            row["earthquake_id"]
+            for row in conn.execute(
+                "SELECT earthquake_id FROM alert_pipeline_events WHERE time_ms >= ?", (since,)
+            )
+        }
+        frame = dataset.frame.iloc[start:stop]
+        lat = dataset.numeric("latitude")[start:stop]
+        lon = dataset.numeric("longitude")[start:stop]
+        mag = dataset.numeric("magnitude")[start:stop]
+        depth = dataset.numeric("depth")[start:stop] if "depth" in frame.columns else np.full(stop - start, np.nan)
+        time_ms = dataset.time_ms[start:stop]
+        ids = frame["earthquake_id"].astype(str).to_numpy()
+        oldest_alertable = int(time.time() * 1000 - Config.ALERT_PIPELINE_MAX_EVENT_AGE_MINUTES * 60_000)
+
+        events: List[Dict[str, Any]] = []
+        for i in range(stop - start):
+            earthquake_id = ids[i]
+            if earthquake_id in seen:
+                continue
+            seen.add(earthquake_id)
+            event = {"earthquake_id": earthquake_id, "time_ms": int(time_ms[i]), "tokens": []}
+            events.append(event)
+            if time_ms[i] < oldest_alertable or not np.isfinite([lat[i], lon[i], mag[i]]).all():
+                continue
+            matches = notifications.match_subscribers(
+                float(lat[i]), float(lon[i]), float(mag[i]), earthquake_id
+            )
+            if matches:
+                depth_km = float(depth[i]) if np.isfinite(depth[i]) else None
+                event["message"] = notifications.earthquake_alert(
+                    earthquake_id, float(lat[i]), float(lon[i]), float(mag[i]), depth_km, "detected"
+                )
+                event["tokens"] = [match["token"] for match in matches]
+
+        jobs = 0
+        now = time.time()
+        try:
+            with token_store.write_transaction() as txn:
+                for event in events:
+                    job_id = None
+                    if event["tokens"]:
+                        title, body, data = event["message"]
+                        job_id = alert_jobs.enqueue(
+                            event["tokens"], title, body, data,
+                            kind="detected", earthquake_id=event["earthquake_id"], txn=txn,
+                        )
+                        jobs += 1
+                    txn.conn.execute(
+                        "INSERT INTO alert_pipeline_events (earthquake_id, time_ms, job_id, processed_at) VALUES (?, ?, ?, ?)",
+                        (event["earthquake_id"], event["time_ms"], job_id, now),
+                    )
+                new_hwm = max(hwm, int(time_ms.max()))
+                _set_high_water_mark(txn.conn, new_hwm)
+                txn.conn.execute(
+                    "DELETE FROM alert_pipeline_events WHERE time_ms < ?", (new_hwm - lookback_ms,)
+                )
+        except sqlite3.IntegrityError:
+            # another process committed some of these events first; it owns their alerts
+            return {"initialized": False, "high_water_mark": hwm, "events": 0, "jobs": 0, "conflict": True}
+        if jobs:
+            alert_jobs.wake()
+        return {"initialized": False, "high_water_mark": new_hwm, "events": len(events), "jobs": jobs}
+
+
+def _loop() -> None:
+    global _last_version
+    while True:
+        try:
+            version, _ = csvio.api_earthquakes_snapshot()
+            if version != _last_version:
+                summary = process_new_events()
+                _last_version = version
+                if summary.get("jobs"):
+                    log.info("%d new events, %d alert jobs", summary["events"], summary["jobs"])
+        except Exception:  # keep polling; the high-water mark makes the retry safe
+            log.exception("alert pipeline error")
+        time.sleep(Config.ALERT_PIPELINE_POLL_SECONDS)
+
+
+def start() -> None:
+    """Start the watcher thread once per process if ALERT_PIPELINE_ENABLED."""
+    global _thread
+    if not Config.ALERT_PIPELINE_ENABLED:
+        return
+    ensure_storage()
+    with _init_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_loop, name="alert-pipeline", daemon=True)
+            _thread.start()
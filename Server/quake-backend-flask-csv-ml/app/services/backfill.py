@@ -0,0 +1,66 @@
+"""Predict a large earthquake catalogue in bounded memory.
+
+Streams an api_earthquakes-style CSV through the models --chunk-rows rows
+at a time (default RECOMPUTE_CHUNK_ROWS) and appends each chunk of
+predictions to the output, which replaces --output only once every chunk
+succeeded. Memory follows the chunk size, so years of history can be
+backfilled on a small machine. Unless --no-verify is given, each chunk is
+checked against the events of the input itself (services.verification), for
+which only their id, time, position and magnitude are kept in memory:
+
+    python -m services.backfill --input history.csv --output history_predictions.csv
+"""
+import argparse
+import sys
+import time
+from typing import Optional
+
+import pandas as pd
+
+from config import Config
+from . import catalog, csvio, ml, verification
+
+
+_VERIFY_COLUMNS = ["id", "time", "latitude", "longitude", "magnitude"]
+
+
+def _detected_events(input_path: str, chunk_rows: int) -> Optional[catalog.Dataset]:
+    parts = [
+        chunk[[c for c in _VERIFY_COLUMNS if c in chunk.columns]]
+        for chunk in csvio.iter_api_earthquakes_csv(input_path, chunk_rows)
+    ]
+    return catalog.detected_from(pd.concat(parts, ignore_index=True)) if parts else None
+
+
+def backfill(input_path: str, output_path: str, chunk_rows: int, verbose: bool = True, verify: bool = True) -> int:
+    """Writes predictions for every row of input_path; returns the number of rows."""
+    chunks = ml.stream_predictions(csvio.iter_api_earthquakes_csv(input_path, chunk_rows))
+    if chunks is None:
+        raise FileNotFoundError(f"Models or scalers not found in {Config.MODELS_DIR}")
+    detected = _detected_events(input_path, chunk_rows) if verify else None
+    rows = 0
+    started = time.perf_counter()
+    with csvio.predictions_out_writer(output_path) as write:
+        for chunk in chunks:
+            write(chunk if detected is None else verification.verify(chunk, detected))
+            rows += len(chunk)
+            if verbose:
+                elapsed = time.perf_counter() - started
+                print(f"{rows} rows ({rows / elapsed if elapsed else 0:.0f} rows/s)", flush=True)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--input", default=Config.API_EARTHQUAKES_CSV)
+    parser.add_argument("--output", default=Config.OUTPUT_PREDICTIONS_CSV)
+    parser.add_argument("--chunk-rows", type=int, default=Config.RECOMPUTE_CHUNK_ROWS)
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--no-verify", action="store_true", help="leave prediction_correct unset")
+    args = parser.parse_args()
+    try:
+        total = backfill(args.input, args.output, args.chunk_rows, verbose=not args.quiet, verify=not args.no_verify)
+    except FileNotFoundError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+    print(f"wrote {total} rows to {args.output}")
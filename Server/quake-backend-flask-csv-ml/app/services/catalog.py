@@ -0,0 +1,173 @@
+"""API-shaped views of the detected and expected datasets.
+
+The frames returned here already carry every field the endpoints serialize
+(time_ms, radius_km, source, ids, ...). They are built once per dataset
+version and shared between requests, so callers must not mutate them.
+"""
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from . import csvio
+from .ml import predict_from_models
+from .spatial import GridIndex
+
+_lock = threading.Lock()
+_detected_memo: Dict[str, Any] = {}
+_expected_memo: Dict[str, Any] = {}
+
+EXPECTED_COLUMNS = [
+    "id", "earthquake_id", "latitude", "longitude", "original_latitude", "original_longitude",
+    "depth", "magnitude", "time", "time_ms", "source", "radius_km", "place",
+]
+
+def estimate_radius_km(magnitude) -> np.ndarray:
+    # Visual-only radius; scales with magnitude (missing magnitude -> minimum radius)
+    mag = pd.to_numeric(pd.Series(magnitude), errors="coerce").fillna(0.0).to_numpy(dtype=float)
+    return np.maximum(5.0, 7.5 * np.power(2.0, mag - 3))
+
+class Dataset:
+    """A catalog frame plus the indexes built over it (rebuilt with the frame).
+
+    Frames are sorted by time_ms, newest first, so row positions double as a
+    time index: a since/until window is a contiguous slice found by binary
+    search, and ascending positions are already in response order.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+        self.time_ms = frame["time_ms"].to_numpy(dtype="int64")
+        # ascending copy of -time_ms for np.searchsorted
+        self._neg_time_ms = -self.time_ms
+        self._columns: Dict[str, np.ndarray] = {}
+        self._spatial: Optional[GridIndex] = None
+        self._index_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def numeric(self, name: str) -> np.ndarray:
+        """Column as a float array (non-numeric -> NaN), computed once per dataset."""
+        values = self._columns.get(name)
+        if values is None:
+            values = pd.to_numeric(self.frame[name], errors="coerce").to_numpy(dtype=float)
+            self._columns[name] = values
+        return values
+
+    def time_window(self, since_ms: Optional[int] = None, until_ms: Optional[int] = None) -> Tuple[int, int]:
+        """[start, stop) positions of rows with since_ms <= time_ms <= until_ms."""
+        start = 0 if until_ms is None else int(np.searchsorted(self._neg_time_ms, -until_ms, side="left"))
+        stop = len(self.frame) if since_ms is None else int(np.searchsorted(self._neg_time_ms, -since_ms, side="right"))
+        return start, max(start, stop)
+
+    @property
+    def spatial(self) -> GridIndex:
+        if self._spatial is None:
+            with self._index_lock:
+                if self._spatial is None:
+                    self._spatial = GridIndex(self.numeric("latitude"), self.numeric("longitude"), Config.SPATIAL_CELL_DEG)
+        return self._spatial
+
+def _sort_newest_first(df: pd.DataFrame) -> pd.DataFrame:
+    order = np.argsort(-df["time_ms"].to_numpy(dtype="int64"), kind="stable")
+    return df.iloc[order].reset_index(drop=True)
+
+def _epoch_ms(values) -> np.ndarray:
+    return pd.to_datetime(values, errors="coerce").astype("int64").to_numpy() // 10**6
+
+def _first_present(primary: pd.Series, fallback: pd.Series) -> pd.Series:
+    # Python-style `a or b` over two columns (None/""/NaN in `a` fall back to `b`)
+    missing = primary.isna() | (primary.astype(object) == "")
+    return primary.where(~missing, fallback)
+
+def _build_detected(api_df: pd.DataFrame) -> pd.DataFrame:
+    df = api_df.copy()
+    df["time_ms"] = _epoch_ms(df["time"])
+    df["radius_km"] = estimate_radius_km(df["magnitude"].values)
+    df["source"] = "detected"
+    if "earthquake_id" not in df.columns:
+        df["earthquake_id"] = df["id"]
+    df["id"] = _first_present(df["id"], df["earthquake_id"])
+    df["earthquake_id"] = _first_present(df["earthquake_id"], df["id"])
+    return _sort_newest_first(df)
+
+def _build_expected(pred_df: pd.DataFrame) -> pd.DataFrame:
+    def col(name, fallback=None):
+        if name in pred_df.columns:
+            return pred_df[name]
+        if fallback is not None:
+            return col(fallback)
+        return pd.Series(None, index=pred_df.index, dtype=object)
+
+    eq_id = col("earthquake_id")
+    if "id" in pred_df.columns:
+        eq_id = _first_present(eq_id, pred_df["id"])
+    derived_id = ("exp-" + eq_id.astype(str)).where(eq_id.notna() & (eq_id.astype(object) != ""), None)
+    row_id = _first_present(pred_df["id"], derived_id) if "id" in pred_df.columns else derived_id
+    if "predicted_time" in pred_df.columns:
+        time_ms = _epoch_ms(pred_df["predicted_time"])
+    else:
+        time_ms = np.zeros(len(pred_df), dtype="int64")
+    out = pd.DataFrame({
+        "id": row_id.astype(object),
+        "earthquake_id": eq_id.astype(object),
+        "latitude": col("predicted_latitude", "latitude"),
+        "longitude": col("predicted_longitude", "longitude"),
+        "original_latitude": col("latitude"),
+        "original_longitude": col("longitude"),
+        "depth": col("predicted_depth", "depth"),
+        "magnitude": col("predicted_magnitude"),
+        "time": col("predicted_time"),
+        "time_ms": time_ms,
+        "source": "expected",
+        "radius_km": estimate_radius_km(col("predicted_magnitude").values),
+        "place": None,
+    }, index=pred_df.index)
+    return _sort_newest_first(out[EXPECTED_COLUMNS])
+
+def detected_from(api_df: pd.DataFrame) -> Dataset:
+    """Dataset over any api_earthquakes-style frame (e.g. a backfill history)."""
+    return Dataset(_build_detected(api_df))
+
+def detected_dataset() -> Dataset:
+    """Detected events (api_earthquakes.csv) shaped like the API records."""
+    version, api_df = csvio.api_earthquakes_snapshot()
+    with _lock:
+        if _detected_memo.get("version") == version:
+            return _detected_memo["dataset"]
+    dataset = detected_from(api_df)
+    with _lock:
+        _detected_memo.update(version=version, dataset=dataset)
+    return dataset
+
+def expected_predictions() -> pd.DataFrame:
+    """Raw prediction rows behind expected_dataset() (shared: do not mutate)."""
+    api_version, api_df = csvio.api_earthquakes_snapshot()
+    pred_df = predict_from_models(api_df, input_key=("api_earthquakes", api_version))
+    if pred_df is None:
+        pred_df = csvio.read_predictions()
+    return pred_df
+
+def expected_dataset() -> Dataset:
+    """Expected events: model predictions when all models are present, else the predictions CSV."""
+    pred_df = expected_predictions()
+    with _lock:
+        # predictions and csv frames are cached upstream, so identity means "unchanged"
+        if _expected_memo.get("source") is pred_df:
+            return _expected_memo["dataset"]
+    dataset = Dataset(_build_expected(pred_df))
+    with _lock:
+        _expected_memo.update(source=pred_df, dataset=dataset)
+    return dataset
+
+def detected_frame() -> pd.DataFrame:
+    return detected_dataset().frame
+
+def expected_frame() -> pd.DataFrame:
+    return expected_dataset().frame
+
+def to_records(frame: pd.DataFrame):
+    return frame.to_dict(orient="records")
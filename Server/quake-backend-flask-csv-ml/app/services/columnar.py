@@ -0,0 +1,132 @@
+"""Memory-mapped NumPy column store for the earthquake catalogues.
+
+A table is a directory holding one ``.npy`` file per column plus a
+``manifest.json`` describing them. Datetime columns are stored pre-parsed as
+int64 epoch milliseconds, numeric columns as their native dtype and text as
+fixed-width unicode, so loading is a set of ``np.load(mmap_mode="r")`` calls
+with no tokenizing or timestamp parsing; processes reading the same table
+share the page cache instead of holding private copies.
+
+Writers never touch files a reader may have mapped: every write uses fresh
+file names and the manifest is swapped in last with ``os.replace``. The
+previous generation stays on disk (listed under ``retired`` in the new
+manifest) so a reader that has just read the old manifest can still open its
+columns; it is deleted by the next write.
+
+Convert the configured CSV files with::
+
+    python -m services.columnar
+"""
+import json
+import os
+import sys
+import uuid
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+_NAT = np.iinfo(np.int64).min
+
+def manifest_path(directory: str) -> str:
+    return os.path.join(directory, MANIFEST)
+
+def _column_kind(series: pd.Series) -> str:
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime_ms"
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(series):
+        return "number"
+    return "str"
+
+def _encode(series: pd.Series, kind: str) -> np.ndarray:
+    if kind == "datetime_ms":
+        values = series.dt.tz_localize(None) if series.dt.tz is not None else series
+        ms = values.to_numpy(dtype="datetime64[ns]").astype("datetime64[ms]").astype(np.int64)
+        ms[series.isna().to_numpy()] = _NAT
+        return ms
+    if kind in ("bool", "number"):
+        return series.to_numpy()
+    text = series.astype(object).where(series.notna(), "").astype(str)
+    return text.to_numpy(dtype=str)
+
+def _decode(values: np.ndarray, kind: str):
+    if kind == "datetime_ms":
+        out = values.astype("datetime64[ms]").astype("datetime64[ns]")
+        out[values == _NAT] = np.datetime64("NaT")
+        return out
+    if kind == "str":
+        text = values.astype(object)
+        text[values == ""] = None
+        return text
+    return values
+
+def write_table(df: pd.DataFrame, directory: str) -> str:
+    """Writes df as a column table in `directory` and returns the manifest path."""
+    os.makedirs(directory, exist_ok=True)
+    generation = uuid.uuid4().hex[:12]
+    columns: List[Dict[str, str]] = []
+    for name in df.columns:
+        kind = _column_kind(df[name])
+        file_name = f"{len(columns):03d}.{generation}.npy"
+        np.save(os.path.join(directory, file_name), _encode(df[name], kind), allow_pickle=False)
+        columns.append({"name": str(name), "kind": kind, "file": file_name})
+    path = manifest_path(directory)
+    previous = _read_manifest(path) if os.path.exists(path) else {}
+    manifest = {
+        "format": FORMAT_VERSION,
+        "rows": int(len(df)),
+        "columns": columns,
+        "retired": [column["file"] for column in previous.get("columns", [])],
+    }
+    tmp_path = f"{path}.{generation}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+    os.replace(tmp_path, path)
+    # Only the generation before the previous one goes: readers of the manifest
+    # just replaced may still be opening its files. Open maps keep their pages.
+    for file_name in previous.get("retired", []):
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError:
+            pass
+    return path
+
+def _read_manifest(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    if manifest.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported column table format in {path}")
+    return manifest
+
+def read_table(directory: str) -> pd.DataFrame:
+    """Loads a column table; numeric columns stay memory-mapped (read-only)."""
+    manifest = _read_manifest(manifest_path(directory))
+    data = {}
+    for column in manifest["columns"]:
+        values = np.load(os.path.join(directory, column["file"]), mmap_mode="r", allow_pickle=False)
+        data[column["name"]] = _decode(values, column["kind"])
+    return pd.DataFrame(data, copy=False)
+
+def convert_csv_sources() -> List[str]:
+    """Converts API_EARTHQUAKES_CSV and PREDICTIONS_CSV into their column tables."""
+    from config import Config
+    from . import csvio
+
+    written = []
+    for csv_path, directory, loader in (
+        (Config.API_EARTHQUAKES_CSV, Config.API_EARTHQUAKES_COLUMNAR_DIR, csvio.load_api_earthquakes_csv),
+        (Config.PREDICTIONS_CSV, Config.PREDICTIONS_COLUMNAR_DIR, csvio.load_predictions_csv),
+    ):
+        if not os.path.exists(csv_path):
+            continue
+        written.append(write_table(loader(csv_path), directory))
+    return written
+
+if __name__ == "__main__":
+    for path in convert_csv_sources():
+        print(f"wrote {path}")
+    sys.exit(0)
@@ -1,8 +1,9 @@
-
-import os, json
+import hashlib, io, os, json, threading
+from contextlib import contextmanager
 import pandas as pd
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from config import Config
+from . import columnar
 
 def ensure_storage():
     os.makedirs(Config.DATA_DIR, exist_ok=True)
@@ -21,12 +22,201 @@ def set_hidden_ids(ids):
     with open(Config.HIDDEN_JSON, "w", encoding="utf-8") as f:
         json.dump({"ids": list(ids)}, f, ensure_ascii=False, indent=2)
 
-def read_api_earthquakes():
-    """Reads CSV with schema like: id,time,latitude,longitude,depth,magnitude"""
-    path = Config.API_EARTHQUAKES_CSV
+# ---------------------------------------------------------------------------
+# Dataset cache
+#
+# Parsed DataFrames are kept in memory and shared by every request (and every
+# thread) until the underlying file changes on disk. Each reload is tagged with
+# a process-wide, monotonically increasing version so that derived data
+# (predictions, indexes, ...) can be memoized against it.
+# Cached frames are shared: callers must not mutate them (copy first).
+# ---------------------------------------------------------------------------
+
+_version_lock = threading.Lock()
+_version_counter = 0
+
+def _next_version() -> int:
+    global _version_counter
+    with _version_lock:
+        _version_counter += 1
+        return _version_counter
+
+def file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    """(mtime_ns, size, inode) of a file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class _DatasetCache:
+    """Holds one parsed dataset and reloads it when its file signature changes.
+
+    `source()` returns (path, loader) so the storage backend can be switched
+    through Config without rebuilding the cache.
+    """
+
+    def __init__(self, source: Callable[[], Tuple[str, Callable[[str], pd.DataFrame]]]):
+        self._source = source
+        self._lock = threading.Lock()
+        # (key, version, frame) swapped as a single reference so readers never
+        # observe a half-updated state without taking the lock.
+        self._state = None
+
+    def get(self) -> Tuple[int, pd.DataFrame]:
+        path, loader = self._source()
+        key = (path, file_signature(path))
+        state = self._state
+        if state is not None and state[0] == key:
+            return state[1], state[2]
+        with self._lock:
+            state = self._state
+            if state is not None and state[0] == key:
+                return state[1], state[2]
+            state = self._reload(path, loader, key, state)
+            self._state = state
+            return state[1], state[2]
+
+    def _reload(self, path, loader, key, previous):
+        return (key, _next_version(), loader(path))
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._state = None
+
+class _AppendableCsvCache(_DatasetCache):
+    """Dataset cache that parses only the appended tail of a growing CSV.
+
+    After each parse it remembers the byte offset reached (always at a line
+    boundary), the header bytes and a hash of every byte before the offset.
+    If the file later has the same inode, is at least as large and its first
+    offset bytes still hash the same, only [offset, EOF) is parsed and merged
+    into the cached frame, rows with an already known `id` replacing the
+    earlier ones. Anything else (any rewrite of ingested bytes, truncation,
+    replaced file) falls back to a full reload. Re-hashing the prefix reads
+    the file but is far cheaper than parsing it.
+    """
+
+    _HASH_BLOCK = 1 << 20
+
+    def __init__(self, source, incremental_loader):
+        super().__init__(source)
+        self._incremental_loader = incremental_loader
+        self._ingest = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._state = None
+            self._ingest = None
+
+    def _reload(self, path, loader, key, previous):
+        if loader is not self._incremental_loader or not Config.APPEND_AWARE_INGEST:
+            self._ingest = None
+            return super()._reload(path, loader, key, previous)
+        try:
+            with open(path, "rb") as handle:
+                st = os.fstat(handle.fileno())
+                ingest = self._ingest
+                hasher = self._verified_prefix(handle, st, ingest) if previous is not None else None
+                if hasher is not None:
+                    return self._merge_tail(handle, key, previous, ingest, hasher)
+                handle.seek(0)
+                data = handle.read()
+        except FileNotFoundError:
+            self._ingest = None
+            return super()._reload(path, loader, key, previous)
+        return self._full_load(data, st, key)
+
+    @staticmethod
+    def _hasher():
+        return hashlib.blake2b(digest_size=16)
+
+    def _verified_prefix(self, handle, st, ingest):
+        """Hasher over the ingested prefix if it is unchanged on disk, else None."""
+        if ingest is None or st.st_ino != ingest["inode"] or st.st_size < ingest["offset"]:
+            return None
+        hasher = self._hasher()
+        handle.seek(0)
+        remaining = ingest["offset"]
+        while remaining:
+            block = handle.read(min(self._HASH_BLOCK, remaining))
+            if not block:
+                return None
+            hasher.update(block)
+            remaining -= len(block)
+        return hasher if hasher.digest() == ingest["digest"] else None
+
+    def _remember(self, digest: bytes, header: bytes, offset: int, inode: int, ids) -> None:
+        self._ingest = {
+            "inode": inode,
+            "offset": offset,
+            "header": header,
+            "digest": digest,
+            "ids": ids,
+        }
+
+    def _full_load(self, data: bytes, st, key):
+        # A trailing line without newline is still loaded, but the offset stays
+        # before it so it is parsed again (and replaced by id) once completed.
+        complete = data[:data.rfind(b"\n") + 1]
+        header = complete[:complete.find(b"\n") + 1]
+        frame = _parse_api_earthquakes(data) if data.strip() else _empty_api_earthquakes()
+        if "id" in frame.columns:
+            frame = frame.drop_duplicates("id", keep="last").reset_index(drop=True)
+        if not header:
+            # no complete header line yet: the next refresh loads in full again
+            self._ingest = None
+            return (key, _next_version(), frame)
+        hasher = self._hasher()
+        hasher.update(complete)
+        ids = set(frame["id"]) if "id" in frame.columns else set()
+        self._remember(hasher.digest(), header, len(complete), st.st_ino, ids)
+        return (key, _next_version(), frame)
+
+    def _merge_tail(self, handle, key, previous, ingest, hasher):
+        handle.seek(ingest["offset"])
+        tail = handle.read()
+        tail = tail[:tail.rfind(b"\n") + 1]
+        if not tail.strip():
+            # nothing complete was appended: keep data and version
+            return (key, previous[1], previous[2])
+        fresh = _parse_api_earthquakes(ingest["header"] + tail)
+        frame = previous[2]
+        ids = ingest["ids"]
+        if "id" in fresh.columns:
+            fresh = fresh.drop_duplicates("id", keep="last")
+            replaced = [i for i in fresh["id"] if i in ids]
+            if replaced:
+                frame = frame[~frame["id"].isin(replaced)]
+            ids.update(fresh["id"])
+        if len(frame) == 0:
+            frame = fresh.reset_index(drop=True)
+        elif len(fresh):
+            frame = pd.concat([frame, fresh], ignore_index=True)
+        hasher.update(tail)
+        self._remember(hasher.digest(), ingest["header"], ingest["offset"] + len(tail), ingest["inode"], ids)
+        return (key, _next_version(), frame)
+
+def _empty_api_earthquakes() -> pd.DataFrame:
+    return pd.DataFrame(columns=["id","time","latitude","longitude","depth","magnitude"])
+
+def _empty_predictions() -> pd.DataFrame:
+    return pd.DataFrame(columns=[
+        "earthquake_id","latitude","longitude","depth",
+        "predicted_latitude","predicted_longitude","predicted_depth",
+        "predicted_magnitude","predicted_time","prediction_timestamp",
+        "predicted_earthquake_id","prediction_correct"
+    ])
+
+def load_api_earthquakes_csv(path: str) -> pd.DataFrame:
     if not os.path.exists(path):
-        return pd.DataFrame(columns=["id","time","latitude","longitude","depth","magnitude"])
-    df = pd.read_csv(path)
+        return _empty_api_earthquakes()
+    return _normalize_api_earthquakes(pd.read_csv(path))
+
+def _parse_api_earthquakes(data: bytes) -> pd.DataFrame:
+    return _normalize_api_earthquakes(pd.read_csv(io.BytesIO(data)))
+
+def _normalize_api_earthquakes(df: pd.DataFrame) -> pd.DataFrame:
     # Normalize columns
     cols = {c.lower(): c for c in df.columns}
     # Force expected names
@@ -45,16 +235,29 @@ def read_api_earthquakes():
     df["source"] = "detected"
     return df
 
-def read_predictions():
-    """Reads CSV with schema like earthquake_predictions.csv provided by user."""
-    path = Config.PREDICTIONS_CSV
+def iter_api_earthquakes_csv(path: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Normalized chunks of an api_earthquakes-style CSV, chunk_rows rows at a time,
+    without loading the whole file. As in the cached snapshot, a repeated id keeps
+    only its last row (found by a first pass over the id column alone)."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    header = pd.read_csv(path, nrows=0).columns
+    id_column = "id" if "id" in header else next((c for c in header if c.lower() == "id"), None)
+    keep = None
+    if id_column is not None:
+        repeated = pd.read_csv(path, usecols=[id_column])[id_column].duplicated(keep="last").to_numpy()
+        keep = ~repeated if repeated.any() else None
+    offset = 0
+    for chunk in pd.read_csv(path, chunksize=max(1, chunk_rows)):
+        rows = len(chunk)
+        if keep is not None:
+            chunk = chunk[keep[offset:offset + rows]]
+        offset += rows
+        yield _normalize_api_earthquakes(chunk)
+
+def load_predictions_csv(path: str) -> pd.DataFrame:
     if not os.path.exists(path):
-        return pd.DataFrame(columns=[
-            "earthquake_id","latitude","longitude","depth",
-            "predicted_latitude","predicted_longitude","predicted_depth",
-            "predicted_magnitude","predicted_time","prediction_timestamp",
-            "predicted_earthquake_id","prediction_correct"
-        ])
+        return _empty_predictions()
     df = pd.read_csv(path)
     # Normalize datetimes if present
     for col in ["predicted_time", "prediction_timestamp"]:
@@ -63,7 +266,110 @@ def read_predictions():
     df["source"] = "expected"
     return df
 
+def _columnar_loader(empty: Callable[[], pd.DataFrame]) -> Callable[[str], pd.DataFrame]:
+    def load(manifest: str) -> pd.DataFrame:
+        if not os.path.exists(manifest):
+            return empty()
+        return columnar.read_table(os.path.dirname(manifest))
+    return load
+
+_load_api_earthquakes_columnar = _columnar_loader(_empty_api_earthquakes)
+_load_predictions_columnar = _columnar_loader(_empty_predictions)
+
+def _use_columnar() -> bool:
+    return Config.STORAGE_BACKEND == "columnar"
+
+def _api_earthquakes_source():
+    if _use_columnar():
+        return columnar.manifest_path(Config.API_EARTHQUAKES_COLUMNAR_DIR), _load_api_earthquakes_columnar
+    return Config.API_EARTHQUAKES_CSV, load_api_earthquakes_csv
+
+def _predictions_source():
+    if _use_columnar():
+        return columnar.manifest_path(Config.PREDICTIONS_COLUMNAR_DIR), _load_predictions_columnar
+    return Config.PREDICTIONS_CSV, load_predictions_csv
+
+_api_earthquakes_cache = _AppendableCsvCache(_api_earthquakes_source, load_api_earthquakes_csv)
+_predictions_cache = _DatasetCache(_predictions_source)
+
+def api_earthquakes_snapshot() -> Tuple[int, pd.DataFrame]:
+    """Returns (version, frame) for api_earthquakes.csv. The frame is shared: do not mutate."""
+    return _api_earthquakes_cache.get()
+
+def predictions_snapshot() -> Tuple[int, pd.DataFrame]:
+    """Returns (version, frame) for the predictions CSV. The frame is shared: do not mutate."""
+    return _predictions_cache.get()
+
+def invalidate_datasets():
+    """Drops every cached dataset; the next read reloads from disk."""
+    _api_earthquakes_cache.invalidate()
+    _predictions_cache.invalidate()
+
+def read_api_earthquakes():
+    """Reads CSV (or its column table) with schema like: id,time,latitude,longitude,depth,magnitude"""
+    return api_earthquakes_snapshot()[1]
+
+def read_predictions():
+    """Reads CSV with schema like earthquake_predictions.csv provided by user."""
+    return predictions_snapshot()[1]
+
+PREDICTION_STORE_COLUMNS = [
+    "earthquake_id","latitude","longitude","depth",
+    "predicted_latitude","predicted_longitude","predicted_depth",
+    "predicted_magnitude","predicted_time","prediction_timestamp",
+    "predicted_earthquake_id","prediction_correct","source",
+    "model_version","input_hash",
+]
+
+def read_prediction_store():
+    """Reads the incremental prediction store (one row per earthquake_id)."""
+    path = Config.PREDICTIONS_STORE_CSV
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=PREDICTION_STORE_COLUMNS)
+    df = pd.read_csv(path, dtype={"earthquake_id": str, "model_version": str, "input_hash": str})
+    for col in ["predicted_time", "prediction_timestamp"]:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+    return df
+
+def append_prediction_store(df):
+    """Appends rows to the prediction store, writing the header if the file is new."""
+    path = Config.PREDICTIONS_STORE_CSV
+    exists = os.path.exists(path) and os.path.getsize(path) > 0
+    df.reindex(columns=PREDICTION_STORE_COLUMNS).to_csv(path, mode="a", header=not exists, index=False)
+    return path
+
+def write_prediction_store(df):
+    """Rewrites the prediction store atomically (temp file + rename)."""
+    path = Config.PREDICTIONS_STORE_CSV
+    tmp_path = f"{path}.tmp"
+    df.reindex(columns=PREDICTION_STORE_COLUMNS).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
 def write_predictions_out(df):
     path = Config.OUTPUT_PREDICTIONS_CSV
     df.to_csv(path, index=False)
     return path
+
+@contextmanager
+def predictions_out_writer(path: Optional[str] = None) -> Iterator[Callable[[pd.DataFrame], None]]:
+    """Yields write(chunk) that appends rows to a temp file, renamed over path
+    (default OUTPUT_PREDICTIONS_CSV) when the block completes (left untouched on error)."""
+    path = path or Config.OUTPUT_PREDICTIONS_CSV
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    written = [False]
+
+    def write(df: pd.DataFrame) -> None:
+        df.to_csv(tmp_path, mode="a" if written[0] else "w", header=not written[0], index=False)
+        written[0] = True
+
+    try:
+        yield write
+        if not written[0]:
+            open(tmp_path, "w").close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
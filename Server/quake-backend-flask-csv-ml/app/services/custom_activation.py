@@ -1,22 +1,37 @@
 # app/services/custom_activation.py
-# Registra la activación custom para Keras 3 al cargar modelos H5.
-# Solo con importar este módulo, la función queda registrada.
+# Activación custom usada por el modelo de profundidad (Keras 3, modelos H5).
+# TensorFlow/Keras se importan recién al usarla: importar este módulo no carga TF.
+# `register()` la registra como serializable antes de cargar modelos.
 
-try:
-    import keras  # Keras 3 (standalone)
-except Exception:
-    from tensorflow import keras  # Fallback a tf.keras si no existe keras separado
+_registered = False
+
+
+def _keras():
+    try:
+        import keras  # Keras 3 (standalone)
+    except Exception:
+        from tensorflow import keras  # Fallback a tf.keras si no existe keras separado
+    return keras
 
-import tensorflow as tf
 
-@keras.saving.register_keras_serializable(package="Custom", name="clip_depth_activation")
 def clip_depth_activation(x):
     """Activación de recorte. Ajusta los límites si tu modelo usa otros.
     Actualmente: [0.0, 1000.0].
     """
     try:
         # Keras 3 API
-        return keras.ops.clip(x, 0.0, 1000.0)
+        return _keras().ops.clip(x, 0.0, 1000.0)
     except Exception:
         # Fallback tf.* por compatibilidad
-        return tf.clip_by_value(x, 0.0, 1000.0)
\ No newline at end of file
+        import tensorflow as tf
+        return tf.clip_by_value(x, 0.0, 1000.0)
+
+
+def register():
+    """Registra la activación en Keras (idempotente)."""
+    global _registered
+    if not _registered:
+        _keras().saving.register_keras_serializable(
+            package="Custom", name="clip_depth_activation"
+        )(clip_depth_activation)
+        _registered = True
@@ -1,36 +1,161 @@
-
+import numpy as np
+import pandas as pd
 from config import Config
+from .spatial import parse_radius_query
+
+def _parse_bbox(raw):
+    try:
+        west, south, east, north = [float(x) for x in raw.split(",")]
+    except Exception:
+        return None
+    return west, south, east, north
+
+def _select(chunk, total: int, predicate, limit):
+    """Evaluates `predicate` over candidate chunks until `limit` rows matched.
+
+    chunk(start, stop) returns candidate positions [start, stop) of `total`;
+    chunks grow geometrically so a "latest N" query touches ~N rows.
+    """
+    if limit is None:
+        candidates = chunk(0, total)
+        return candidates[predicate(candidates)]
+    found = []
+    matched = 0
+    start = 0
+    step = max(2 * limit, 256)
+    while start < total and matched < limit:
+        candidates = chunk(start, min(start + step, total))
+        keep = candidates[predicate(candidates)]
+        found.append(keep)
+        matched += len(keep)
+        start += step
+        step *= 2
+    if not found:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(found)[:limit]
 
-def apply_filters(rows, args, hidden_ids):
-    # rows: list of dicts
-    out = rows
-    if args.get("hide", "1") == "1":
-        out = [r for r in out if r.get("id") not in hidden_ids]
-    # magnitude filters
-    if "min_mag" in args:
-        mm = float(args.get("min_mag"))
-        out = [r for r in out if float(r.get("magnitude", r.get("predicted_magnitude", 0)) or 0) >= mm]
-    if "max_mag" in args:
-        mx = float(args.get("max_mag"))
-        out = [r for r in out if float(r.get("magnitude", r.get("predicted_magnitude", 0)) or 0) <= mx]
+def filter_dataset(dataset, args, hidden_ids) -> pd.DataFrame:
+    """Applies the querystring filters to a catalog dataset (see services.catalog).
+
+    The dataset is sorted newest first, so since_ms/until_ms become a binary
+    searched slice and bbox/radius come from the spatial index; the remaining
+    predicates run as one vectorized mask over those candidates only, stopping
+    once `limit` rows matched. Radius queries add a `distance_km` column.
+    """
+    frame = dataset.frame
     # time filters (epoch ms or ISO handled by client; server only supports since_ms/until_ms if provided)
-    if "since_ms" in args:
-        since = int(args.get("since_ms"))
-        out = [r for r in out if int(r.get("time_ms", r.get("predicted_time_ms", 0)) or 0) >= since]
-    if "until_ms" in args:
-        until = int(args.get("until_ms"))
-        out = [r for r in out if int(r.get("time_ms", r.get("predicted_time_ms", 0)) or 0) <= until]
-    # bbox filter
+    since = int(args.get("since_ms")) if "since_ms" in args else None
+    until = int(args.get("until_ms")) if "until_ms" in args else None
+    start, stop = dataset.time_window(since, until)
+
+    # spatial candidates (sorted positions) restricted to the time window
+    positions = None
+    distances = None
     if "bbox" in args:
-        try:
-            west, south, east, north = [float(x) for x in args.get("bbox").split(",")]
-            def inside(lat, lon):
-                return south <= float(lat) <= north and west <= float(lon) <= east
-            out = [r for r in out if inside(r.get("latitude", r.get("predicted_latitude")), r.get("longitude", r.get("predicted_longitude")))]
-        except Exception:
-            pass
+        bbox = _parse_bbox(args.get("bbox"))
+        if bbox is not None:
+            positions = dataset.spatial.query_bbox(*bbox)
+    radius = parse_radius_query(args)
+    if radius is not None:
+        near, dist = dataset.spatial.query_radius(*radius)
+        if positions is not None:
+            keep = np.isin(near, positions, assume_unique=True)
+            near, dist = near[keep], dist[keep]
+        positions, distances = near, dist
+    if positions is not None:
+        lo, hi = np.searchsorted(positions, [start, stop])
+        positions = positions[lo:hi]
+        if distances is not None:
+            distances = distances[lo:hi]
+        total = len(positions)
+        chunk = lambda a, b: positions[a:b]
+    else:
+        total = stop - start
+        chunk = lambda a, b: np.arange(start + a, start + b)
+
+    # magnitude / hidden predicates
+    hide = args.get("hide", "1") == "1" and bool(hidden_ids)
+    min_mag = float(args.get("min_mag")) if "min_mag" in args else None
+    max_mag = float(args.get("max_mag")) if "max_mag" in args else None
+    mag = dataset.numeric("magnitude") if min_mag is not None or max_mag is not None else None
+    ids = frame["id"]
+
+    def predicate(candidates):
+        mask = np.ones(len(candidates), dtype=bool)
+        if hide:
+            mask &= ~ids.iloc[candidates].isin(hidden_ids).to_numpy()
+        if min_mag is not None:
+            mask &= mag[candidates] >= min_mag
+        if max_mag is not None:
+            mask &= mag[candidates] <= max_mag
+        return mask
+
     # limit
+    limit = None
     if "limit" in args:
-        lim = max(1, min(int(args.get("limit")), Config.MAX_LIMIT))
-        out = out[:lim]
+        limit = max(1, min(int(args.get("limit")), Config.MAX_LIMIT))
+    selected = _select(chunk, total, predicate, limit)
+    out = frame.iloc[selected]
+    if distances is not None:
+        out = out.assign(distance_km=distances[np.searchsorted(positions, selected)])
     return out
+
+def _within(values: np.ndarray, min_value, max_value) -> np.ndarray:
+    # NaN passes, like the scalar `val < min` / `val > max` checks it replaces
+    mask = np.ones(len(values), dtype=bool)
+    if min_value is not None:
+        mask &= ~(values < min_value)
+    if max_value is not None:
+        mask &= ~(values > max_value)
+    return mask
+
+def _pair_keys(frame: pd.DataFrame) -> pd.Series:
+    keys = frame["earthquake_id"]
+    return keys.where(keys.notna() & (keys.astype(object) != ""), None)
+
+def pair_datasets(detected, expected, real_bounds, expected_bounds, hidden_ids, limit=None):
+    """Joins detected and expected datasets on earthquake_id.
+
+    bounds dicts hold min_mag/max_mag/min_depth/max_depth (None = unbounded).
+    The join, range filters and the newest-first sort key are array ops; only
+    the top `limit` pairs (partial selection) are materialized as JSON dicts.
+    """
+    real_frame, exp_frame = detected.frame, expected.frame
+    real_keys = _pair_keys(real_frame)
+    # one entry per key, the last occurrence wins (as with a dict lookup)
+    real_pos = np.flatnonzero(real_keys.notna().to_numpy() & ~real_keys.duplicated(keep="last").to_numpy())
+    exp_keys = _pair_keys(exp_frame)
+    exp_unique = np.flatnonzero(exp_keys.notna().to_numpy() & ~exp_keys.duplicated(keep="last").to_numpy())
+    exp_index = pd.Index(exp_keys.iloc[exp_unique])
+    match = exp_index.get_indexer(real_keys.iloc[real_pos])
+    joined = match >= 0
+    real_pos, exp_pos = real_pos[joined], exp_unique[match[joined]]
+
+    mask = np.ones(len(real_pos), dtype=bool)
+    if hidden_ids:
+        mask &= ~real_frame["id"].iloc[real_pos].isin(hidden_ids).to_numpy()
+        mask &= ~exp_frame["id"].iloc[exp_pos].isin(hidden_ids).to_numpy()
+    for dataset, pos, bounds in ((detected, real_pos, real_bounds), (expected, exp_pos, expected_bounds)):
+        mask &= _within(dataset.numeric("magnitude")[pos], bounds.get("min_mag"), bounds.get("max_mag"))
+        if bounds.get("min_depth") is not None or bounds.get("max_depth") is not None:
+            mask &= _within(dataset.numeric("depth")[pos], bounds.get("min_depth"), bounds.get("max_depth"))
+    real_pos, exp_pos = real_pos[mask], exp_pos[mask]
+
+    sort_key = np.maximum(detected.time_ms[real_pos], expected.time_ms[exp_pos])
+    if limit is not None and limit < len(sort_key):
+        # partial selection; keep every row tied with the k-th key so the
+        # stable sort below still decides ties by dataset order
+        kth = np.partition(-sort_key, limit - 1)[limit - 1]
+        candidates = np.flatnonzero(-sort_key <= kth)
+    else:
+        candidates = np.arange(len(sort_key))
+    order = candidates[np.argsort(-sort_key[candidates], kind="stable")]
+    if limit is not None:
+        order = order[:limit]
+
+    real_records = real_frame.iloc[real_pos[order]].to_dict(orient="records")
+    exp_records = exp_frame.iloc[exp_pos[order]].to_dict(orient="records")
+    return [
+        {"earthquake_id": real["earthquake_id"], "real": real, "expected": exp}
+        for real, exp in zip(real_records, exp_records)
+    ]
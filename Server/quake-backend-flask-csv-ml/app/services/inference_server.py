@@ -0,0 +1,355 @@
+"""Out-of-process model inference shared by every web worker.
+
+Run one server next to the web workers (from the app directory)::
+
+    INFERENCE_SERVER_AUTHKEY=<secret> python -m services.inference_server
+
+and start the workers with the same INFERENCE_SERVER_ADDRESS and
+INFERENCE_SERVER_AUTHKEY. The server listens on DEFAULT_ADDRESS (loopback)
+unless given another one, and refuses non-loopback TCP hosts without
+--allow-remote. The key has no default: messages are pickled, so anyone who
+can authenticate can run code in the server, and neither side starts
+without it.
+
+The server owns the only copy of the models (the registry in services.ml,
+with its reload checks); workers skip TensorFlow and send the engineered
+numeric feature columns of each prediction request over a local socket
+(multiprocessing.connection).
+
+Requests that arrive within INFERENCE_SERVER_BATCH_WINDOW_MS of each other
+are scaled per request and run through the fused models as one batch, then
+split back per caller. When the server is unset or unreachable, workers
+fall back to in-process inference and retry the server after
+INFERENCE_SERVER_RETRY_SECONDS.
+"""
+import argparse
+import ipaddress
+import logging
+import queue
+import socket
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener, answer_challenge, deliver_challenge
+from multiprocessing import AuthenticationError
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from . import ml
+
+Address = Union[str, Tuple[str, int]]
+
+DEFAULT_ADDRESS = "127.0.0.1:6010"
+
+log = logging.getLogger(__name__)
+
+
+def parse_address(value: str) -> Address:
+    """"host:port" -> TCP address (a bare port means 127.0.0.1); anything else
+    is a Unix socket path."""
+    if value.isdigit():
+        return "127.0.0.1", int(value)
+    host, sep, port = value.rpartition(":")
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return value
+
+
+def is_loopback(address: Address) -> bool:
+    """True for Unix sockets and TCP hosts that resolve only to loopback addresses."""
+    if isinstance(address, str):
+        return True
+    try:
+        infos = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+def _authkey() -> bytes:
+    if not Config.INFERENCE_SERVER_AUTHKEY:
+        raise ValueError("INFERENCE_SERVER_AUTHKEY is not set")
+    return Config.INFERENCE_SERVER_AUTHKEY.encode("utf-8")
+
+
+# ---------------------------------------------------------------------------
+# Server
+# ---------------------------------------------------------------------------
+
+class _Request:
+    def __init__(self, snapshot: Dict[str, Any], inputs: List[np.ndarray]):
+        self.snapshot = snapshot
+        self.inputs = inputs
+        self.rows = len(inputs[0])
+        self.outputs: Optional[List[np.ndarray]] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class InferenceServer:
+    """Accepts connections and micro-batches their predict requests."""
+
+    def __init__(self, address: Address, window_ms: Optional[float] = None, allow_remote: bool = False):
+        global _serving
+        if not Config.INFERENCE_SERVER_AUTHKEY:
+            raise ValueError("INFERENCE_SERVER_AUTHKEY must be set to run the inference server")
+        if not allow_remote and not is_loopback(address):
+            raise ValueError(f"refusing to listen on non-loopback address {address!r} (pass --allow-remote)")
+        _serving = True  # this process runs the models itself, whatever the environment says
+        # authentication runs on the connection's thread (Listener.accept would
+        # do it inline, so one slow client would stall every other connect)
+        self.listener = Listener(address, backlog=128)
+        self.window = max(0.0, Config.INFERENCE_SERVER_BATCH_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "rows": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def address(self) -> Address:
+        return self.listener.address
+
+    def serve_forever(self) -> None:
+        threading.Thread(target=self._batch_loop, name="inference-batcher", daemon=True).start()
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError as exc:
+                log.warning("accept failed: %s", exc)
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), name="inference-conn", daemon=True).start()
+
+    def _serve_connection(self, conn: Connection) -> None:
+        with conn:
+            try:
+                deliver_challenge(conn, _authkey())
+                answer_challenge(conn, _authkey())
+            except (AuthenticationError, EOFError, OSError) as exc:
+                log.warning("rejected connection: %s", exc)
+                return
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = self._handle(message)
+                except Exception as exc:  # report to the caller, keep the connection
+                    reply = ("error", f"{type(exc).__name__}: {exc}")
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def _handle(self, message) -> Tuple[str, Any]:
+        kind = message[0]
+        if kind == "status":
+            with self._stats_lock:
+                stats = dict(self.stats)
+            snapshot = ml.loaded_models()
+            fingerprints = {t: entry["fingerprint"] for t, entry in snapshot["targets"].items()}
+            return "ok", {"status": ml.model_status(), "fingerprints": fingerprints, "stats": stats}
+        if kind == "predict":
+            snapshot = ml.loaded_models()
+            if snapshot["missing"]:
+                return "missing", list(snapshot["missing"])
+            df = pd.DataFrame(message[1])
+            scalers = [snapshot["targets"][t]["scaler"] for t in ml.TARGETS]
+            request = _Request(snapshot, ml._scaled_inputs(df, scalers))
+            self._queue.put(request)
+            request.done.wait()
+            if request.error is not None:
+                return "error", request.error
+            return "ok", {"model_version": snapshot["model_version"], "outputs": request.outputs}
+        return "error", f"unknown request {kind!r}"
+
+    def _collect(self) -> List[_Request]:
+        first = self._queue.get()
+        batch, rows = [first], first.rows
+        deadline = time.monotonic() + self.window
+        while rows < Config.INFERENCE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += request.rows
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = self._collect()
+            groups: Dict[str, List[_Request]] = {}
+            for request in batch:
+                groups.setdefault(request.snapshot["model_version"], []).append(request)
+            for requests in groups.values():
+                self._run(requests)
+
+    def _run(self, requests: List[_Request]) -> None:
+        try:
+            engine = ml._fused_models(requests[0].snapshot)
+            merged = [np.concatenate([r.inputs[k] for r in requests]) for k in range(len(ml.TARGETS))]
+            outputs = engine(merged)
+            offset = 0
+            for request in requests:
+                request.outputs = [y[offset:offset + request.rows] for y in outputs]
+                offset += request.rows
+        except Exception as exc:
+            for request in requests:
+                request.error = f"{type(exc).__name__}: {exc}"
+        finally:
+            with self._stats_lock:
+                self.stats["requests"] += len(requests)
+                self.stats["batches"] += 1
+                self.stats["rows"] += sum(r.rows for r in requests)
+            for request in requests:
+                request.done.set()
+
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+
+class ServerUnavailable(RuntimeError):
+    pass
+
+
+_serving = False
+_warned_no_key = False
+_local = threading.local()
+_state_lock = threading.Lock()
+_down_until = 0.0
+_status: Optional[Tuple[float, Dict[str, Any]]] = None  # (checked_at, status reply)
+
+
+def enabled() -> bool:
+    global _warned_no_key
+    if not Config.INFERENCE_SERVER_ADDRESS or _serving:
+        return False
+    if not Config.INFERENCE_SERVER_AUTHKEY:
+        if not _warned_no_key:
+            _warned_no_key = True
+            log.warning("INFERENCE_SERVER_AUTHKEY is not set; using in-process inference")
+        return False
+    return True
+
+
+def _connection() -> Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = Client(parse_address(Config.INFERENCE_SERVER_ADDRESS), authkey=_authkey())
+        _local.conn = conn
+    return conn
+
+
+def _drop_connection() -> None:
+    conn = getattr(_local, "conn", None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+
+def _call(message) -> Tuple[str, Any]:
+    global _down_until
+    if time.monotonic() < _down_until:
+        raise ServerUnavailable("inference server marked down")
+    try:
+        conn = _connection()
+        conn.send(message)
+        if not conn.poll(Config.INFERENCE_SERVER_TIMEOUT_SECONDS):
+            raise TimeoutError("no reply from inference server")
+        return conn.recv()
+    except (OSError, EOFError, AuthenticationError, TimeoutError) as exc:
+        # a late reply would desync this connection: always start over
+        _drop_connection()
+        with _state_lock:
+            _down_until = time.monotonic() + Config.INFERENCE_SERVER_RETRY_SECONDS
+        log.warning("inference server unavailable (%s); using in-process inference", exc)
+        raise ServerUnavailable(str(exc)) from exc
+
+
+def remote_status() -> Optional[Dict[str, Any]]:
+    """Server's model_status(), re-fetched at most every MODELS_RELOAD_INTERVAL_SECONDS.
+    None when the server is disabled or unreachable."""
+    global _status
+    if not enabled():
+        return None
+    now = time.monotonic()
+    cached = _status
+    if cached is not None and now - cached[0] < Config.MODELS_RELOAD_INTERVAL_SECONDS:
+        return cached[1]
+    try:
+        kind, payload = _call(("status",))
+    except ServerUnavailable:
+        return None
+    if kind != "ok":
+        return None
+    _status = (now, payload)
+    return payload
+
+
+def remote_snapshot() -> Optional[Dict[str, Any]]:
+    """A model snapshot shaped like ml.loaded_models() for the server's models
+    (no model objects; "remote" marks it), or None to use in-process models."""
+    reply = remote_status()
+    if reply is None:
+        return None
+    status = reply["status"]
+    return {
+        "version": status["version"],
+        "model_version": status["model_version"],
+        "targets": {t: {"fingerprint": fingerprint} for t, fingerprint in reply["fingerprints"].items()},
+        "missing": list(status["missing"]),
+        "remote": Config.INFERENCE_SERVER_ADDRESS,
+        "status": status,
+    }
+
+
+def predict(features: pd.DataFrame) -> List[np.ndarray]:
+    """Model outputs (one array per ml.TARGETS entry) for engineered features.
+
+    Raises ServerUnavailable when the caller should run the models itself.
+    """
+    columns = {
+        name: features[name].to_numpy()
+        for name in features.select_dtypes(include=["number"]).columns
+    }
+    kind, payload = _call(("predict", columns))
+    if kind != "ok":
+        raise ServerUnavailable(f"inference server answered {kind}: {payload}")
+    return payload["outputs"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--address", default=None,
+        help=f"host:port, port or socket path (default INFERENCE_SERVER_ADDRESS, else {DEFAULT_ADDRESS})",
+    )
+    parser.add_argument("--window-ms", type=float, default=None, help="micro-batch window (default INFERENCE_SERVER_BATCH_WINDOW_MS)")
+    parser.add_argument("--allow-remote", action="store_true", help="allow listening on a non-loopback TCP address")
+    args = parser.parse_args()
+    address = args.address or Config.INFERENCE_SERVER_ADDRESS or DEFAULT_ADDRESS
+    try:
+        server = InferenceServer(parse_address(address), window_ms=args.window_ms, allow_remote=args.allow_remote)
+    except ValueError as exc:
+        parser.error(str(exc))
+    status = ml.model_status()
+    print(f"[inference_server] listening on {server.address}; models ready={status['ready']} missing={status['missing']}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # services.ml imports this module by name; make that the running one so it
+    # sees this process is the server (and does not connect to itself)
+    sys.modules["services.inference_server"] = sys.modules[__name__]
+    main()
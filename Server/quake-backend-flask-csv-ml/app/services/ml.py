@@ -1,9 +1,17 @@
 
+import atexit
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+from . import custom_activation
 from .custom_activation import clip_depth_activation
+from . import csvio
+from .csvio import file_signature
 from config import Config
 
 # Optional heavy imports guarded to avoid failures when models are absent
@@ -12,12 +20,32 @@ try:
 except Exception:  # pragma: no cover
     joblib = None
 
-try:
-    import tensorflow as tf
-    from tensorflow import keras
-except Exception:  # pragma: no cover
-    tf = None
-    keras = None
+# TensorFlow is imported on first model load, not at import time: workers that
+# never run inference (health, hidden, alerts) skip its startup time and memory.
+_tf_lock = threading.Lock()
+_tf_modules: Optional[Tuple[Any, Any]] = None
+
+def _tensorflow() -> Tuple[Any, Any]:
+    """(tensorflow, keras), or (None, None) when TensorFlow is not installed."""
+    global _tf_modules
+    with _tf_lock:
+        if _tf_modules is None:
+            try:
+                import tensorflow as tf
+                from tensorflow import keras
+                _tf_modules = (tf, keras)
+            except Exception:  # pragma: no cover
+                _tf_modules = (None, None)
+        return _tf_modules
+
+def _tflite_interpreter():
+    """tflite_runtime's Interpreter if installed (no full TF needed), else tf.lite's."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except Exception:
+        tf, _ = _tensorflow()
+        return tf.lite.Interpreter if tf is not None else None
 
 def _custom_objects():
     # Custom functions used in training (depth model per metodología)
@@ -30,24 +58,73 @@ def _custom_objects():
         return tf.reduce_mean(tf.square(y_true - y_pred))
     return {"clip_depth_activation": clip_depth_activation, "weighted_mse": weighted_mse}
 
-def load_model_and_scaler(target: str):
-    """Loads Keras .h5 and scaler .pkl for a target among: latitude, longitude, depth, magnitude.
-    Returns (model, scaler) or (None, None) if not available.
+TARGETS = ["latitude","longitude","depth","magnitude"]
+
+def model_paths(target: str, model_format: Optional[str] = None) -> Tuple[str, str]:
+    """Returns (model_path, scaler_path) for a target inside MODELS_DIR.
+
+    model_format is "h5" (Keras) or "tflite" (see services.ml_export);
+    defaults to MODEL_FORMAT.
     """
     models_dir = Config.MODELS_DIR
+    model_format = model_format or Config.MODEL_FORMAT
     h5_name = {
         "latitude": "earthquake_latitude_model.h5",
         "longitude": "earthquake_longitude_model.h5",
         "depth": "earthquake_depth_model.h5",
         "magnitude": "earthquake_magnitude_model.h5",
     }[target]
+    if model_format == "tflite":
+        h5_name = os.path.splitext(h5_name)[0] + ".tflite"
     pkl_name = f"scaler_{target}.pkl"
-    model_path = os.path.join(models_dir, h5_name)
-    scaler_path = os.path.join(models_dir, pkl_name)
+    return os.path.join(models_dir, h5_name), os.path.join(models_dir, pkl_name)
+
+class TFLiteModel:
+    """A .tflite export of one target model, with the predict() surface of a Keras model.
+
+    The interpreter is not thread-safe, so calls are serialized per model.
+    """
+
+    def __init__(self, path: str):
+        Interpreter = _tflite_interpreter()
+        if Interpreter is None:
+            raise RuntimeError("No TFLite interpreter available (install tflite-runtime or tensorflow)")
+        self._interpreter = Interpreter(model_path=path)
+        self._lock = threading.Lock()
+        details = self._interpreter.get_input_details()[0]
+        self._input_index = details["index"]
+        self._output_index = self._interpreter.get_output_details()[0]["index"]
+        self.input_shape = (None, int(details["shape"][-1]))
+        self._rows = None
+
+    def predict(self, X, verbose=0) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if len(X) == 0:
+            return np.zeros((0, 1), dtype=np.float32)
+        with self._lock:
+            if self._rows != len(X):
+                self._interpreter.resize_tensor_input(self._input_index, [len(X), self.input_shape[1]])
+                self._interpreter.allocate_tensors()
+                self._rows = len(X)
+            self._interpreter.set_tensor(self._input_index, X)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output_index).copy()
+
+def load_model_and_scaler(target: str, model_format: Optional[str] = None):
+    """Loads the model (Keras .h5 or .tflite, per MODEL_FORMAT) and scaler .pkl for a
+    target among: latitude, longitude, depth, magnitude.
+    Returns (model, scaler) or (None, None) if not available.
+    """
+    model_path, scaler_path = model_paths(target, model_format)
 
     model = None
     scaler = None
-    if keras and os.path.exists(model_path):
+    if model_path.endswith(".tflite"):
+        if os.path.exists(model_path):
+            model = TFLiteModel(model_path)
+    elif os.path.exists(model_path) and _tensorflow()[1] is not None:
+        _, keras = _tensorflow()
+        custom_activation.register()
         model = keras.models.load_model(
             model_path,
             custom_objects={
@@ -60,6 +137,121 @@ def load_model_and_scaler(target: str):
         scaler = joblib.load(scaler_path)
     return model, scaler
 
+def _content_hash(*paths: str) -> str:
+    """Digest of the files' bytes; stable across copies/redeploys unlike mtime."""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        if not os.path.exists(path):
+            digest.update(b"<missing>")
+            continue
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+class _ModelRegistry:
+    """Process-wide cache of (model, scaler) per target.
+
+    Models are deserialized once and shared across threads. MODELS_DIR is
+    re-checked at most every MODELS_RELOAD_INTERVAL_SECONDS; targets whose
+    files changed are reloaded and the whole set is swapped in one assignment,
+    so readers always see a consistent snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+
+    @staticmethod
+    def _fingerprint(target: str):
+        model_path, scaler_path = model_paths(target)
+        return (model_path, file_signature(model_path), scaler_path, file_signature(scaler_path))
+
+    def _is_fresh(self, now: float) -> bool:
+        return (
+            self._snapshot is not None
+            and now - self._checked_at < Config.MODELS_RELOAD_INTERVAL_SECONDS
+        )
+
+    def snapshot(self, force_check: bool = False) -> Dict[str, Any]:
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if not force_check and self._is_fresh(now):
+            return snapshot
+        with self._lock:
+            if not force_check and self._is_fresh(now):
+                return self._snapshot
+            previous = self._snapshot or {"version": 0, "targets": {}}
+            targets = {}
+            changed = False
+            for t in TARGETS:
+                fingerprint = self._fingerprint(t)
+                entry = previous["targets"].get(t)
+                if entry is None or entry["fingerprint"] != fingerprint:
+                    model, scaler = load_model_and_scaler(t)
+                    entry = {
+                        "model": model,
+                        "scaler": scaler,
+                        "fingerprint": fingerprint,
+                        "content_hash": _content_hash(fingerprint[0], fingerprint[2]),
+                    }
+                    changed = True
+                targets[t] = entry
+            if changed or self._snapshot is None:
+                model_version = hashlib.blake2b(digest_size=8)
+                for t in TARGETS:
+                    model_version.update(targets[t]["content_hash"].encode("ascii"))
+                self._snapshot = {
+                    "version": previous["version"] + 1,
+                    "model_version": model_version.hexdigest(),
+                    "targets": targets,
+                    "missing": [t for t in TARGETS if targets[t]["model"] is None],
+                }
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+_registry = _ModelRegistry()
+
+def loaded_models(force_check: bool = False) -> Dict[str, Any]:
+    """Current model snapshot: {"version", "model_version", "targets": {t: {...}}, "missing"}."""
+    return _registry.snapshot(force_check=force_check)
+
+def _active_snapshot() -> Dict[str, Any]:
+    """The inference server's snapshot when INFERENCE_SERVER_ADDRESS is set and
+    reachable (see services.inference_server), otherwise the in-process one."""
+    from . import inference_server
+    if inference_server.enabled():
+        snapshot = inference_server.remote_snapshot()
+        if snapshot is not None:
+            return snapshot
+    return loaded_models()
+
+def models_ready() -> bool:
+    return not _active_snapshot()["missing"]
+
+def model_status() -> Dict[str, Any]:
+    """JSON-friendly summary of which targets are loaded or missing."""
+    snapshot = _active_snapshot()
+    if snapshot.get("remote"):
+        return dict(snapshot["status"], inference_server=snapshot["remote"])
+    targets = {}
+    for t, entry in snapshot["targets"].items():
+        model_path, _, scaler_path, _ = entry["fingerprint"]
+        targets[t] = {
+            "model_loaded": entry["model"] is not None,
+            "scaler_loaded": entry["scaler"] is not None,
+            "model_path": model_path,
+            "scaler_path": scaler_path,
+        }
+    return {
+        "version": snapshot["version"],
+        "model_version": snapshot["model_version"],
+        "ready": not snapshot["missing"],
+        "missing": list(snapshot["missing"]),
+        "targets": targets,
+    }
+
 def _feature_engineering(df: pd.DataFrame) -> pd.DataFrame:
     out = df.copy()
     # time features
@@ -79,44 +271,398 @@ def _feature_engineering(df: pd.DataFrame) -> pd.DataFrame:
             out[col] = pd.to_numeric(out[col], errors="coerce").fillna(0.0)
     return out
 
-def _align_to_scaler(df: pd.DataFrame, scaler) -> pd.DataFrame:
-    if scaler is None:
-        # Fallback to reasonable default feature set
-        cols = ["latitude","longitude","depth","magnitude","time_numeric","year","month","day","lat_lon_interaction"]
-        for c in cols:
-            if c not in df.columns:
-                df[c] = 0.0
-        return df[cols]
-    # If scaler exposes feature names, reindex; else pass-through numeric columns
-    feature_names = getattr(scaler, "feature_names_in_", None)
-    if feature_names is not None:
-        aligned = pd.DataFrame(index=df.index)
-        for name in feature_names:
-            aligned[name] = df[name] if name in df.columns else 0.0
-        return aligned
-    # generic
-    return df.select_dtypes(include=["number"]).fillna(0.0)
-
-def predict_from_models(api_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+# Prediction cache: (input key, model fingerprints) -> predictions DataFrame.
+# Bounded LRU; cached frames are shared, callers must copy before mutating.
+_prediction_cache: "OrderedDict[Tuple, pd.DataFrame]" = OrderedDict()
+_prediction_cache_lock = threading.Lock()
+_prediction_compute_lock = threading.Lock()
+
+def _frame_fingerprint(df: pd.DataFrame) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(list(df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def _prediction_cache_get(key) -> Optional[pd.DataFrame]:
+    with _prediction_cache_lock:
+        cached = _prediction_cache.get(key)
+        if cached is not None:
+            _prediction_cache.move_to_end(key)
+        return cached
+
+def _prediction_cache_put(key, df: pd.DataFrame) -> None:
+    with _prediction_cache_lock:
+        _prediction_cache[key] = df
+        _prediction_cache.move_to_end(key)
+        while len(_prediction_cache) > max(0, Config.PREDICTION_CACHE_SIZE):
+            _prediction_cache.popitem(last=False)
+
+def clear_prediction_cache() -> None:
+    with _prediction_cache_lock:
+        _prediction_cache.clear()
+
+def predict_from_models(api_df: pd.DataFrame, input_key=None, use_cache: bool = True) -> Optional[pd.DataFrame]:
     """Produce predictions for each target using available models/scalers.
     If some model is missing, returns None (caller may fallback to existing predictions CSV).
+
+    Results are memoized by (input_key, model fingerprints). ``input_key`` should
+    identify the input rows (e.g. the csvio dataset version); when omitted a
+    content hash of ``api_df`` is used. The returned frame may be shared with
+    the cache: copy it before mutating.
+    """
+    snapshot = _active_snapshot()
+    if snapshot["missing"]:
+        return None
+    if input_key is None:
+        input_key = _frame_fingerprint(api_df)
+    key = (input_key, tuple(snapshot["targets"][t]["fingerprint"] for t in TARGETS))
+    if use_cache:
+        cached = _prediction_cache_get(key)
+        if cached is not None:
+            return cached
+    with _prediction_compute_lock:
+        if use_cache:
+            cached = _prediction_cache_get(key)
+            if cached is not None:
+                return cached
+        if Config.INCREMENTAL_PREDICTIONS:
+            out, _ = _predict_incremental(api_df, snapshot)
+        else:
+            out = _run_models(api_df, snapshot)
+        _prediction_cache_put(key, out)
+    return out
+
+# ---------------------------------------------------------------------------
+# Incremental prediction store
+#
+# Predictions are a pure function of each input row and the models, so they
+# are persisted per earthquake_id together with the model version and a hash
+# of the row's inputs. Only rows that are new or whose inputs/models changed
+# are sent through the models; results are appended (or upserted) to
+# PREDICTIONS_STORE_CSV instead of rewriting the whole output file.
+# ---------------------------------------------------------------------------
+
+_INPUT_COLUMNS = ["id","time","latitude","longitude","depth","magnitude"]
+_store_lock = threading.Lock()
+_store_state: Optional[Tuple[Any, pd.DataFrame]] = None  # (file signature, frame indexed by earthquake_id)
+
+def _row_hashes(api_df: pd.DataFrame) -> np.ndarray:
+    cols = [c for c in _INPUT_COLUMNS if c in api_df.columns]
+    hashed = pd.util.hash_pandas_object(api_df[cols], index=False).values
+    return np.array([format(int(h), "016x") for h in hashed], dtype=object)
+
+def _load_store_unlocked() -> pd.DataFrame:
+    global _store_state
+    signature = file_signature(Config.PREDICTIONS_STORE_CSV)
+    if _store_state is not None and _store_state[0] == signature:
+        return _store_state[1]
+    store = csvio.read_prediction_store()
+    store["earthquake_id"] = store["earthquake_id"].astype(str)
+    store = store.drop_duplicates("earthquake_id", keep="last").set_index("earthquake_id", drop=False)
+    _store_state = (signature, store)
+    return store
+
+def predict_incremental(
+    api_df: pd.DataFrame, progress: Optional[Callable[[int, int], None]] = None
+) -> Optional[Tuple[pd.DataFrame, int]]:
+    """Predicts only new/changed rows and upserts them into the prediction store.
+    Returns (predictions aligned to api_df, number of rows predicted), or None if models are missing.
+    ``progress(done, total)`` is called after each chunk of predicted rows.
     """
-    targets = ["latitude","longitude","depth","magnitude"]
-    models = {}
-    for t in targets:
-        model, scaler = load_model_and_scaler(t)
-        models[t] = (model, scaler)
-    if any(m[0] is None for m in models.values()):
+    snapshot = _active_snapshot()
+    if snapshot["missing"]:
         return None
+    with _prediction_compute_lock:
+        return _predict_incremental(api_df, snapshot, progress)
+
+def _predict_incremental(
+    api_df: pd.DataFrame, snapshot: Dict[str, Any], progress: Optional[Callable[[int, int], None]] = None
+) -> Tuple[pd.DataFrame, int]:
+    global _store_state
+    model_version = snapshot["model_version"]
+    ids = api_df["id"].astype(str)
+    hashes = _row_hashes(api_df)
+    with _store_lock:
+        store = _load_store_unlocked()
+        stale = (
+            (ids.map(store["input_hash"]).values != hashes)
+            | (ids.map(store["model_version"]).values != model_version)
+        )
+        pending = api_df[stale]
+        if len(pending):
+            pending_hashes = pd.Series(hashes[stale], index=pending.index)
+            keep = ~pending["id"].astype(str).duplicated(keep="last").values
+            pending, pending_hashes = pending[keep], pending_hashes[keep]
+            chunks = []
+            for chunk in _iter_predictions(pending, snapshot):
+                chunks.append(chunk)
+                if progress is not None:
+                    progress(sum(len(c) for c in chunks), len(pending))
+            fresh = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+            fresh["earthquake_id"] = fresh["earthquake_id"].astype(str)
+            fresh["model_version"] = model_version
+            fresh["input_hash"] = pending_hashes.values
+            fresh = fresh.set_index("earthquake_id", drop=False)
+            replaced = fresh.index.isin(store.index)
+            if replaced.any():
+                store = pd.concat([store.drop(fresh.index[replaced]), fresh])
+                csvio.write_prediction_store(store)
+            else:
+                store = pd.concat([store, fresh]) if len(store) else fresh
+                csvio.append_prediction_store(fresh)
+            _store_state = (file_signature(Config.PREDICTIONS_STORE_CSV), store)
+        out = store.reindex(ids.values)
+    out = out.drop(columns=["model_version", "input_hash"])
+    out.index = api_df.index
+    return out, int(len(pending))
+
+def iter_predictions(api_df: pd.DataFrame, chunk_rows: Optional[int] = None) -> Optional[Iterator[pd.DataFrame]]:
+    """Predictions for api_df, chunk_rows (default RECOMPUTE_CHUNK_ROWS) input rows at a
+    time so feature engineering and model inputs stay bounded; None if models are missing.
+    Uncached: meant for recompute jobs that write the chunks out as they come.
+    """
+    snapshot = _active_snapshot()
+    if snapshot["missing"]:
+        return None
+    return _iter_predictions(api_df, snapshot, chunk_rows)
+
+def stream_predictions(chunks: Iterable[pd.DataFrame]) -> Optional[Iterator[pd.DataFrame]]:
+    """Predictions for each chunk of input rows (e.g. csvio.iter_api_earthquakes_csv),
+    yielded as computed; None if models are missing. Model inputs are written into
+    buffers allocated once and reused, so memory follows the chunk size, not the catalogue.
+    """
+    snapshot = _active_snapshot()
+    if snapshot["missing"]:
+        return None
+    return _stream_predictions(chunks, snapshot)
+
+def _stream_predictions(chunks: Iterable[pd.DataFrame], snapshot: Dict[str, Any]) -> Iterator[pd.DataFrame]:
+    buffers = _InputBuffers()
+    for chunk in chunks:
+        yield _predictions_frame(chunk, _model_outputs(chunk, snapshot, buffers))
+
+def _iter_predictions(
+    api_df: pd.DataFrame, snapshot: Dict[str, Any], chunk_rows: Optional[int] = None
+) -> Iterator[pd.DataFrame]:
+    step = max(1, chunk_rows or Config.RECOMPUTE_CHUNK_ROWS)
+    return _stream_predictions((api_df.iloc[start:start + step] for start in range(0, len(api_df), step)), snapshot)
+
+_DEFAULT_FEATURES = ["latitude","longitude","depth","magnitude","time_numeric","year","month","day","lat_lon_interaction"]
+
+def _scaler_features(scaler, df: pd.DataFrame) -> Tuple[list, bool]:
+    """(feature names, fill NaN with 0) for one target's model input.
+
+    Named features follow the scaler (absent columns read as 0); without a
+    scaler the default feature set is used; a scaler without names gets
+    every numeric column.
+    """
+    if scaler is None:
+        return list(_DEFAULT_FEATURES), False
+    feature_names = getattr(scaler, "feature_names_in_", None)
+    if feature_names is not None:
+        return [str(name) for name in feature_names], False
+    return list(df.select_dtypes(include=["number"]).columns), True
+
+def _scale(scaler, X: np.ndarray, names: list) -> np.ndarray:
+    if scaler is None:
+        return X
+    if hasattr(scaler, "with_mean") and hasattr(scaler, "scale_"):
+        # StandardScaler.transform, without the DataFrame/validation round-trip
+        if scaler.with_mean:
+            X = X - scaler.mean_
+        if scaler.with_std:
+            X = X / scaler.scale_
+        return X
+    if getattr(scaler, "feature_names_in_", None) is not None:
+        return scaler.transform(pd.DataFrame(X, columns=names))
+    return scaler.transform(X)
+
+def _scaled_inputs(df: pd.DataFrame, scalers: list) -> list:
+    """Scaled model inputs for every target from one shared feature matrix."""
+    selections = [_scaler_features(scaler, df) for scaler in scalers]
+    union = list(dict.fromkeys(name for names, _ in selections for name in names))
+    matrix = np.zeros((len(df), len(union)), dtype=float)
+    for j, name in enumerate(union):
+        if name in df.columns:
+            matrix[:, j] = df[name].to_numpy(dtype=float)
+    position = {name: j for j, name in enumerate(union)}
+    inputs = []
+    for scaler, (names, fill_na) in zip(scalers, selections):
+        X = matrix[:, [position[name] for name in names]]
+        if fill_na:
+            X = np.where(np.isnan(X), 0.0, X)
+        inputs.append(_scale(scaler, X, names))
+    return inputs
+
+class _FeatureColumns:
+    """Engineered feature columns of raw input rows, as float64 arrays computed on
+    first use with the rules of _feature_engineering (which copies the whole frame)."""
+
+    _NUMERIC = ("latitude", "longitude", "depth", "magnitude")
+    _TIME = ("year", "month", "day", "time_numeric")
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._columns: Dict[str, np.ndarray] = {}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        column = self._columns.get(name)
+        if column is None:
+            if name in self._TIME:
+                self._columns.update(self._time_features())
+            else:
+                self._columns[name] = self._compute(name)
+            column = self._columns[name]
+        return column
+
+    def _time_features(self) -> Dict[str, np.ndarray]:
+        rows = len(self.df)
+        if "time" not in self.df.columns:
+            return {"year": np.full(rows, 1970.0), "month": np.ones(rows), "day": np.ones(rows), "time_numeric": np.zeros(rows)}
+        t = pd.to_datetime(self.df["time"], errors="coerce", utc=True).dt.tz_convert(None)
+        return {
+            "year": t.dt.year.fillna(1970).astype(int).to_numpy(dtype=float),
+            "month": t.dt.month.fillna(1).astype(int).to_numpy(dtype=float),
+            "day": t.dt.day.fillna(1).astype(int).to_numpy(dtype=float),
+            "time_numeric": ((t - pd.Timestamp("1970-01-01")).dt.total_seconds().fillna(0) / (24*3600.0)).to_numpy(dtype=float),
+        }
+
+    def _compute(self, name: str) -> np.ndarray:
+        df = self.df
+        if name == "lat_lon_interaction":
+            return self._numeric(df.get("latitude", 0) * df.get("longitude", 0))
+        if name not in df.columns:
+            return np.zeros(len(df))
+        if name in self._NUMERIC:
+            return self._numeric(df[name])
+        return df[name].to_numpy(dtype=float)
+
+    def _numeric(self, values) -> np.ndarray:
+        if not isinstance(values, pd.Series):
+            return np.full(len(self.df), float(values))
+        return pd.to_numeric(values, errors="coerce").fillna(0.0).to_numpy(dtype=float)
+
+class _InputBuffers:
+    """float32 model input matrices per target, grown to the largest chunk and reused."""
+
+    def __init__(self):
+        self._arrays: Dict[int, np.ndarray] = {}
+
+    def get(self, key: int, rows: int, cols: int) -> np.ndarray:
+        array = self._arrays.get(key)
+        if array is None or array.shape[0] < rows or array.shape[1] != cols:
+            array = np.empty((rows, cols), dtype=np.float32)
+            self._arrays[key] = array
+        return array[:rows]
+
+def _direct_inputs(api_df: pd.DataFrame, scalers: list, buffers: _InputBuffers) -> Optional[list]:
+    """Scaled model inputs built from the raw rows column by column into buffers:
+    the same values _scaled_inputs(_feature_engineering(api_df)) gives, without the
+    intermediate frames. None when a scaler needs those frames (no feature names, or
+    not a StandardScaler)."""
+    plans = []
+    for scaler in scalers:
+        if scaler is None:
+            plans.append((list(_DEFAULT_FEATURES), None, None))
+        elif (
+            hasattr(scaler, "with_mean") and hasattr(scaler, "scale_")
+            and getattr(scaler, "feature_names_in_", None) is not None
+        ):
+            plans.append((
+                [str(name) for name in scaler.feature_names_in_],
+                scaler.mean_ if scaler.with_mean else None,
+                scaler.scale_ if scaler.with_std else None,
+            ))
+        else:
+            return None
+    features = _FeatureColumns(api_df)
+    inputs = []
+    for k, (names, mean, scale) in enumerate(plans):
+        X = buffers.get(k, len(api_df), len(names))
+        for j, name in enumerate(names):
+            column = features[name]
+            if mean is not None:
+                column = column - mean[j]
+            if scale is not None:
+                column = column / scale[j]
+            X[:, j] = column
+        inputs.append(X)
+    return inputs
+
+class _FusedModels:
+    """The per-target models behind a single compiled call.
+
+    Calling the models directly inside one tf.function skips predict()'s
+    per-call setup (data adapter, callbacks, per-32-row batching), which
+    dominates for the small batches the API serves. Rows are fed in chunks
+    of INFERENCE_BATCH_SIZE to bound activation memory on large inputs.
+    Models that cannot be traced (e.g. TFLiteModel) use their predict().
+    """
+
+    def __init__(self, models: list):
+        self.models = models
+        self._run = None
+        tf, keras = _tensorflow()
+        if keras is not None and all(
+            isinstance(model, keras.Model) and len(model.input_shape) == 2 for model in models
+        ):
+            specs = [tf.TensorSpec([None, model.input_shape[-1]], tf.float32) for model in models]
+
+            @tf.function(input_signature=specs)
+            def run(*inputs):
+                return [tf.reshape(model(x, training=False), [-1]) for model, x in zip(models, inputs)]
+
+            self._run = run
+
+    def __call__(self, inputs: list) -> list:
+        rows = len(inputs[0])
+        step = max(1, Config.INFERENCE_BATCH_SIZE)
+        chunks = [[] for _ in inputs]
+        for start in range(0, rows, step):
+            batch = [np.asarray(X[start:start + step], dtype=np.float32) for X in inputs]
+            if self._run is None:
+                outputs = [model.predict(X, verbose=0).reshape(-1) for model, X in zip(self.models, batch)]
+            else:
+                outputs = [y.numpy() for y in self._run(*batch)]
+            for out, y in zip(chunks, outputs):
+                out.append(y)
+        return [np.concatenate(out) if out else np.zeros(0, dtype=np.float32) for out in chunks]
+
+_fused_lock = threading.Lock()
+_fused: Dict[str, Any] = {}
+# Drop the compiled engine before interpreter teardown; a tf.function collected
+# after TensorFlow's modules are cleared raises noise from its __del__.
+atexit.register(_fused.clear)
+
+def _fused_models(snapshot: Dict[str, Any]) -> _FusedModels:
+    """Compiled engine for the snapshot's models, rebuilt when they change."""
+    with _fused_lock:
+        if _fused.get("model_version") != snapshot["model_version"]:
+            models = [snapshot["targets"][t]["model"] for t in TARGETS]
+            _fused.update(model_version=snapshot["model_version"], engine=_FusedModels(models))
+        return _fused["engine"]
+
+def _model_outputs(api_df: pd.DataFrame, snapshot: Dict[str, Any], buffers: Optional[_InputBuffers] = None) -> list:
+    """One output array per target for the input rows ``api_df``."""
+    if snapshot.get("remote"):
+        from . import inference_server
+        try:
+            return inference_server.predict(_feature_engineering(api_df))
+        except inference_server.ServerUnavailable:
+            snapshot = loaded_models()
+            if snapshot["missing"]:
+                raise RuntimeError(f"Inference server unavailable and models missing locally: {snapshot['missing']}")
+    scalers = [snapshot["targets"][t]["scaler"] for t in TARGETS]
+    inputs = _direct_inputs(api_df, scalers, buffers or _InputBuffers())
+    if inputs is None:
+        inputs = _scaled_inputs(_feature_engineering(api_df), scalers)
+    return _fused_models(snapshot)(inputs)
+
+def _run_models(api_df: pd.DataFrame, snapshot: Dict[str, Any]) -> pd.DataFrame:
+    return _predictions_frame(api_df, _model_outputs(api_df, snapshot))
 
-    df = _feature_engineering(api_df)
-    preds = {}
-    for t in targets:
-        model, scaler = models[t]
-        X = _align_to_scaler(df, scaler)
-        Xs = scaler.transform(X) if scaler is not None else X.values
-        y = model.predict(Xs, verbose=0).reshape(-1)
-        preds[t] = y
+def _predictions_frame(api_df: pd.DataFrame, outputs: list) -> pd.DataFrame:
+    preds = dict(zip(TARGETS, outputs))
 
     out = pd.DataFrame({
         "earthquake_id": api_df["id"].values,
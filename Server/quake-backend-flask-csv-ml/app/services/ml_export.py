@@ -0,0 +1,59 @@
+"""Export the Keras target models to TFLite.
+
+Writes ``earthquake_<target>_model.tflite`` next to each ``.h5`` in
+MODELS_DIR and checks the export against the Keras model on random input.
+Serve the exports with ``MODEL_FORMAT=tflite``; with the ``tflite-runtime``
+package installed the server then never imports TensorFlow.
+
+    python -m services.ml_export
+"""
+import os
+import sys
+
+import numpy as np
+
+from .ml import TARGETS, TFLiteModel, _tensorflow, load_model_and_scaler, model_paths
+
+def export_target(target: str) -> str:
+    """Convert one target's .h5 model; returns the .tflite path written."""
+    tf, _ = _tensorflow()
+    if tf is None:
+        raise RuntimeError("TensorFlow is required to export models")
+    model, _ = load_model_and_scaler(target, "h5")
+    if model is None:
+        raise FileNotFoundError(model_paths(target, "h5")[0])
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+    # The MLIR converter fails on Keras 3 variable reads (from_keras_model() and
+    # traced calls alike), so convert a traced call with weights frozen to constants.
+    call = tf.function(
+        lambda x: model(x, training=False),
+        input_signature=[tf.TensorSpec([None, model.input_shape[-1]], tf.float32)],
+    )
+    frozen = convert_variables_to_constants_v2(call.get_concrete_function())
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([frozen])
+    flatbuffer = converter.convert()
+
+    out_path, _ = model_paths(target, "tflite")
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(flatbuffer)
+    os.replace(tmp_path, out_path)
+
+    sample = np.random.default_rng(0).normal(size=(64, model.input_shape[-1])).astype(np.float32)
+    expected = model.predict(sample, verbose=0).reshape(-1)
+    exported = TFLiteModel(out_path).predict(sample).reshape(-1)
+    max_diff = float(np.max(np.abs(expected - exported)))
+    if not np.isfinite(max_diff) or max_diff > 1e-3 * max(1.0, float(np.max(np.abs(expected)))):
+        raise ValueError(f"{target}: TFLite export differs from Keras model (max abs diff {max_diff})")
+    return out_path
+
+if __name__ == "__main__":
+    status = 0
+    for target in TARGETS:
+        try:
+            print(f"wrote {export_target(target)}")
+        except (FileNotFoundError, ValueError) as exc:
+            print(f"skipped {target}: {exc}", file=sys.stderr)
+            status = 1
+    sys.exit(status)
@@ -3,21 +3,31 @@ import json
 import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import requests
+import requests.adapters
 from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2 import service_account
 
 from config import Config
+from . import token_store
+from .subscribers import SubscriberIndex
 
 
 SERVICE_ACCOUNT_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
 
 _credentials_lock = threading.Lock()
-_entries_lock = threading.Lock()
+_mirror_lock = threading.Lock()
+_session_lock = threading.Lock()
+_session: Optional[requests.Session] = None
 _service_account_credentials: Optional[service_account.Credentials] = None
 _service_account_project_id: Optional[str] = None
+# In-memory mirror of the token table plus the subscriber index built from it;
+# guarded by _mirror_lock and rebuilt whenever the store generation moves
+# behind our back (another process, or a write we could not fold in).
+_mirror: Optional[Dict[str, Any]] = None
 
 
 class NotificationSendError(RuntimeError):
@@ -25,12 +35,8 @@ class NotificationSendError(RuntimeError):
 
 
 def ensure_storage() -> None:
-    """Ensure the token storage file exists."""
-    path = Config.DEVICE_TOKENS_JSON
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not os.path.exists(path):
-        with open(path, "w", encoding="utf-8") as handle:
-            json.dump([], handle)
+    """Ensure the token database exists (importing the legacy JSON file once)."""
+    token_store.initialize()
 
 
 def _root_dir() -> str:
@@ -100,33 +106,63 @@ def _load_service_account_credentials() -> Tuple[service_account.Credentials, st
 
 def _load_entries() -> List[Dict[str, Any]]:
     ensure_storage()
-    path = Config.DEVICE_TOKENS_JSON
-    try:
-        with open(path, "r", encoding="utf-8") as handle:
-            data = json.load(handle)
-            if isinstance(data, list):
-                return data
-    except (json.JSONDecodeError, OSError):
-        pass
-    return []
-
-
-def _write_entries(entries: List[Dict[str, Any]]) -> None:
-    path = Config.DEVICE_TOKENS_JSON
-    with open(path, "w", encoding="utf-8") as handle:
-        json.dump(entries, handle, ensure_ascii=False, indent=2)
+    return list(token_store.load_entries().values())
 
 
 def _load_entries_map_unlocked() -> Dict[str, Dict[str, Any]]:
-    return {
-        entry.get("token"): entry
-        for entry in _load_entries()
-        if entry.get("token")
-    }
-
-
-def _write_entries_map_unlocked(entries_map: Dict[str, Dict[str, Any]]) -> None:
-    _write_entries(list(entries_map.values()))
+    return token_store.load_entries()
+
+
+def _apply_write(
+    txn: token_store.Transaction,
+    *entries: Dict[str, Any],
+    deliveries: Optional[Dict[str, Tuple[List[str], List[str]]]] = None,
+) -> None:
+    """Fold the entries (and token -> (added, evicted) deliveries) of a
+    committed write into the mirror, or drop the mirror if another writer
+    (thread or process) committed in between."""
+    global _mirror
+    if txn.generation is None or txn.generation[0] == txn.generation[1]:
+        return
+    with _mirror_lock:
+        if _mirror is None or _mirror["generation"] != txn.generation[0]:
+            _mirror = None
+            return
+        for entry in entries:
+            token = entry["token"]
+            _mirror["entries"][token] = copy.deepcopy(entry)
+            if entry.get("deactivated_at"):
+                _mirror["index"].remove(token)
+            else:
+                _mirror["index"].upsert(token, entry.get("preferences"))
+        delivered = _mirror["delivered"]
+        for token, (added, evicted) in (deliveries or {}).items():
+            for earthquake_id in added:
+                delivered.setdefault(earthquake_id, set()).add(token)
+            for earthquake_id in evicted:
+                tokens = delivered.get(earthquake_id)
+                if tokens is not None:
+                    tokens.discard(token)
+                    if not tokens:
+                        del delivered[earthquake_id]
+        _mirror["generation"] = txn.generation[1]
+
+
+def _mirror_unlocked() -> Dict[str, Any]:
+    global _mirror
+    generation = token_store.generation()
+    if _mirror is None or _mirror["generation"] != generation:
+        generation, entries = token_store.snapshot()
+        index = SubscriberIndex(Config.ALERT_INDEX_CELL_DEG)
+        # earthquake_id -> tokens already alerted, for O(1) dedup per match
+        delivered: Dict[str, set] = {}
+        for token, entry in entries.items():
+            if not entry.get("deactivated_at"):
+                index.upsert(token, entry.get("preferences"))
+            for earthquake_id in entry.pop("delivered_ids", None) or []:
+                delivered.setdefault(earthquake_id, set()).add(token)
+        _mirror = {"generation": generation, "entries": entries, "index": index, "delivered": delivered}
+    return _mirror
 
 
 def register_token(token: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
@@ -135,32 +171,152 @@ def register_token(token: str, metadata: Optional[Dict[str, Any]] = None) -> Dic
         raise ValueError("Token must be a non-empty string")
 
     now = int(time.time())
-    with _entries_lock:
-        entries = _load_entries_map_unlocked()
-        entry = entries.get(token) or {"token": token, "created_at": now}
+    with token_store.write_transaction() as txn:
+        entry = txn.get(token) or {"token": token, "created_at": now}
         entry["token"] = token
         entry.setdefault("created_at", now)
         entry["updated_at"] = now
+        entry["last_seen_at"] = now
+        _reactivate(entry)
         if metadata:
             existing_metadata = entry.get("metadata") or {}
             existing_metadata.update(metadata)
             entry["metadata"] = existing_metadata
-        entries[token] = entry
-        _write_entries_map_unlocked(entries)
-        return copy.deepcopy(entry)
+        txn.put(entry)
+    _apply_write(txn, entry)
+    return copy.deepcopy(entry)
 
 
 def list_tokens() -> List[str]:
-    with _entries_lock:
-        return list(_load_entries_map_unlocked().keys())
+    """Tokens a broadcast should target: registered, not deactivated, not stale."""
+    return broadcast_targets()[0]
+
+
+def _reactivate(entry: Dict[str, Any]) -> None:
+    # A register/preferences call proves the app is alive on this token again.
+    entry.pop("deactivated_at", None)
+    entry.pop("deactivated_reason", None)
+
+
+def _stale_cutoff() -> Optional[int]:
+    if Config.TOKEN_STALE_DAYS <= 0:
+        return None
+    return int(time.time() - Config.TOKEN_STALE_DAYS * 86400)
+
+
+def _skip_reason(entry: Optional[Dict[str, Any]], cutoff: Optional[int]) -> Optional[str]:
+    if not entry:
+        return None
+    if entry.get("deactivated_at"):
+        return "deactivated"
+    # last_seen_at moves only on register/preferences calls, never on deliveries
+    seen = entry.get("last_seen_at") or entry.get("updated_at") or entry.get("created_at") or 0
+    if cutoff is not None and seen < cutoff:
+        return "stale"
+    return None
+
+
+def broadcast_targets(tokens: Optional[Iterable[str]] = None) -> Tuple[List[str], Dict[str, int]]:
+    """Filter tokens (default: every registered token) down to live ones.
+
+    Returns (tokens, skipped) where skipped counts the tokens left out as
+    "deactivated" (FCM reported them dead) or "stale" (the app has not
+    registered or updated preferences within TOKEN_STALE_DAYS). Tokens not in the store are kept as given.
+    """
+    cutoff = _stale_cutoff()
+    with _mirror_lock:
+        entries = _mirror_unlocked()["entries"]
+        candidates = list(entries) if tokens is None else [token for token in tokens if token]
+        skipped = {"deactivated": 0, "stale": 0}
+        targets: List[str] = []
+        for token in candidates:
+            reason = _skip_reason(entries.get(token), cutoff)
+            if reason:
+                skipped[reason] += 1
+            else:
+                targets.append(token)
+    return targets, skipped
+
+
+# FCM v1 error codes meaning the token itself will never work again.
+DEAD_TOKEN_ERRORS = {"UNREGISTERED", "SENDER_ID_MISMATCH"}
+
+
+def dead_token_reason(response: Dict[str, Any]) -> Optional[str]:
+    """FCM error code if a send response shows the token is dead, else None.
+
+    INVALID_ARGUMENT is also returned for malformed payloads, so it only
+    counts when FCM's message blames the registration token.
+    """
+    if response.get("success"):
+        return None
+    error = (response.get("response") or {}).get("error")
+    if not isinstance(error, dict):
+        return None
+    codes = {error.get("status")}
+    for detail in error.get("details") or []:
+        if isinstance(detail, dict):
+            codes.add(detail.get("errorCode"))
+    dead = codes & DEAD_TOKEN_ERRORS
+    if dead:
+        return sorted(dead)[0]
+    if "INVALID_ARGUMENT" in codes and "registration token" in str(error.get("message", "")).lower():
+        return "INVALID_ARGUMENT"
+    return None
+
+
+def deactivate_tokens(reasons: Dict[str, str]) -> int:
+    """Mark tokens as deactivated (token -> reason) in one transaction.
+
+    Deactivated tokens drop out of broadcasts and subscriber matching until
+    the app registers them again. Returns how many were newly deactivated.
+    """
+    if not reasons:
+        return 0
+    now = int(time.time())
+    changed: List[Dict[str, Any]] = []
+    with token_store.write_transaction() as txn:
+        for token, reason in reasons.items():
+            entry = txn.get(token)
+            if entry is None or entry.get("deactivated_at"):
+                continue
+            entry["deactivated_at"] = now
+            entry["deactivated_reason"] = reason
+            txn.put(entry)
+            changed.append(entry)
+    _apply_write(txn, *changed)
+    return len(changed)
+
+
+def prune_dead_tokens(responses: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    """Deactivate every token whose send response says it is dead."""
+    reasons = {}
+    for response in responses:
+        reason = dead_token_reason(response)
+        if reason and response.get("token"):
+            reasons[response["token"]] = reason
+    deactivate_tokens(reasons)
+    return reasons
+
+
+class _StaticCredentials:
+    """Fixed bearer token (FCM_ACCESS_TOKEN), e.g. for tools/fcm_stub.py."""
+
+    valid = True
+
+    def __init__(self, token: str):
+        self.token = token
 
 
 def _ensure_credentials_ready() -> Tuple[service_account.Credentials, str, GoogleRequest]:
-    credentials, project_id = _load_service_account_credentials()
-    auth_request = GoogleRequest()
-    with _credentials_lock:
-        if not credentials.valid:
-            credentials.refresh(auth_request)
+    if Config.FCM_ACCESS_TOKEN:
+        if not Config.FCM_PROJECT_ID:
+            raise NotificationSendError("FCM_PROJECT_ID is required when FCM_ACCESS_TOKEN is set")
+        credentials, project_id = _StaticCredentials(Config.FCM_ACCESS_TOKEN), Config.FCM_PROJECT_ID
+    else:
+        credentials, project_id = _load_service_account_credentials()
+    auth_request = GoogleRequest(session=_http_session())
+    _bearer_token(credentials, auth_request)
     return credentials, project_id, auth_request
 
 
@@ -177,11 +333,7 @@ def _normalize_data(data: Optional[Dict[str, Any]]) -> Dict[str, str]:
 
 def load_entries_snapshot() -> Dict[str, Dict[str, Any]]:
     """Return a deep copy of all token entries for read-only operations."""
-    with _entries_lock:
-        return {
-            token: copy.deepcopy(entry)
-            for token, entry in _load_entries_map_unlocked().items()
-        }
+    return _load_entries_map_unlocked()
 
 
 def update_preferences(
@@ -196,11 +348,12 @@ def update_preferences(
         raise ValueError("Token must be a non-empty string")
 
     now = int(time.time())
-    with _entries_lock:
-        entries = _load_entries_map_unlocked()
-        entry = entries.get(token) or {"token": token, "created_at": now}
+    with token_store.write_transaction() as txn:
+        entry = txn.get(token) or {"token": token, "created_at": now}
         entry.setdefault("created_at", now)
         entry["updated_at"] = now
+        entry["last_seen_at"] = now
+        _reactivate(entry)
         entry["preferences"] = {
             "latitude": latitude,
             "longitude": longitude,
@@ -208,48 +361,166 @@ def update_preferences(
             "minimum_magnitude": minimum_magnitude,
             "updated_at": now,
         }
-        entries[token] = entry
-        _write_entries_map_unlocked(entries)
-        return copy.deepcopy(entry)
+        txn.put(entry)
+    _apply_write(txn, entry)
+    return copy.deepcopy(entry)
 
 
 def record_delivery(token: str, earthquake_id: str, max_history: int = 100) -> None:
-    if not earthquake_id:
-        return
-    token = (token or "").strip()
-    if not token:
-        return
+    record_deliveries([(token, earthquake_id)], max_history=max_history)
+
+
+def record_deliveries(
+    deliveries: Iterable[Tuple[str, str]],
+    max_history: int = 100,
+) -> int:
+    """Record a batch of (token, earthquake_id) deliveries in one transaction.
+
+    Each token's delivered_ids keeps only its last max_history ids. Returns
+    the number of deliveries that were not already recorded.
+    """
+    by_token: Dict[str, List[str]] = {}
+    for token, earthquake_id in deliveries:
+        token = (token or "").strip()
+        if token and earthquake_id:
+            by_token.setdefault(token, []).append(earthquake_id)
+    if not by_token:
+        return 0
 
     now = int(time.time())
-    with _entries_lock:
-        entries = _load_entries_map_unlocked()
-        entry = entries.get(token) or {"token": token, "created_at": now}
-        delivered = entry.get("delivered_ids") or []
-        if earthquake_id in delivered:
-            return
-        delivered.append(earthquake_id)
-        if len(delivered) > max_history:
-            delivered = delivered[-max_history:]
-        entry["delivered_ids"] = delivered
-        entry["updated_at"] = now
-        entries[token] = entry
-        _write_entries_map_unlocked(entries)
-
-
-def has_received_alert(entry: Dict[str, Any], earthquake_id: Optional[str]) -> bool:
-    if not earthquake_id:
-        return False
-    delivered = entry.get("delivered_ids") or []
-    return earthquake_id in delivered
+    recorded = 0
+    changed: List[Dict[str, Any]] = []
+    applied: Dict[str, Tuple[List[str], List[str]]] = {}
+    with token_store.write_transaction() as txn:
+        for token, earthquake_ids in by_token.items():
+            added, evicted = txn.add_deliveries(token, earthquake_ids, max_history, now)
+            if not added:
+                continue
+            entry = txn.get(token) or {"token": token, "created_at": now}
+            entry["updated_at"] = now
+            txn.put(entry)
+            changed.append(entry)
+            applied[token] = (added, evicted)
+            recorded += len(added)
+    _apply_write(txn, *changed, deliveries=applied)
+    return recorded
+
+
+def match_subscribers(
+    latitude: float,
+    longitude: float,
+    magnitude: float,
+    earthquake_id: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Subscribers whose alert radius contains the event and whose minimum
+    magnitude it meets, skipping those already alerted for earthquake_id
+    and deactivated or stale tokens.
+    Each match has token, distance_km, radius_km and min_magnitude."""
+    with _mirror_lock:
+        mirror = _mirror_unlocked()
+        matches = mirror["index"].match(latitude, longitude, magnitude)
+        entries = mirror["entries"]
+        already_alerted = mirror["delivered"].get(earthquake_id, ()) if earthquake_id else ()
+        cutoff = _stale_cutoff()
+        return [
+            match for match in matches
+            if match["token"] not in already_alerted
+            and _skip_reason(entries.get(match["token"]), cutoff) is None
+        ]
+
+
+def _http_session() -> requests.Session:
+    """Shared keep-alive session whose pool fits FCM_MAX_WORKERS senders."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            workers = max(1, Config.FCM_MAX_WORKERS)
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def _bearer_token(credentials: service_account.Credentials, auth_request: GoogleRequest) -> str:
+    # google-auth treats a token as invalid shortly before it expires, so the
+    # refresh happens ahead of expiry, once, by whichever sender sees it first.
+    if not credentials.valid:
+        with _credentials_lock:
+            if not credentials.valid:
+                credentials.refresh(auth_request)
+    return credentials.token
 
 
-def send_notification(
-    tokens: Iterable[str],
+def _send_one(
+    session: requests.Session,
+    url: str,
+    token: str,
     title: str,
     body: str,
-    data: Optional[Dict[str, Any]] = None,
-    dry_run: bool = False,
+    payload_data: Dict[str, str],
+    dry_run: bool,
+    credentials: service_account.Credentials,
+    auth_request: GoogleRequest,
+    capture_errors: bool = False,
 ) -> Dict[str, Any]:
+    message_payload: Dict[str, Any] = {
+        "message": {
+            "token": token,
+            "notification": {
+                "title": title,
+                "body": body,
+            },
+            "data": payload_data.copy() if payload_data else {},
+        }
+    }
+    if dry_run:
+        message_payload["validate_only"] = True
+
+    headers = {
+        "Authorization": f"Bearer {_bearer_token(credentials, auth_request)}",
+        "Content-Type": "application/json; charset=UTF-8",
+    }
+
+    try:
+        response = session.post(
+            url,
+            headers=headers,
+            json=message_payload,
+            timeout=Config.FCM_TIMEOUT_SECONDS,
+        )
+    except requests.RequestException as exc:
+        if not capture_errors:
+            raise NotificationSendError(f"Failed to reach FCM: {exc}") from exc
+        return {
+            "status_code": None,
+            "success": 0,
+            "failure": 1,
+            "token": token,
+            "response": {"error": f"Failed to reach FCM: {exc}"},
+        }
+
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = {"raw": response.text}
+
+    is_success = response.status_code == 200
+    result = {
+        "status_code": response.status_code,
+        "success": 1 if is_success else 0,
+        "failure": 0 if is_success else 1,
+        "token": token,
+        "response": response_json,
+    }
+    retry_after = response.headers.get("Retry-After")
+    if not is_success and retry_after:
+        result["retry_after"] = retry_after
+    return result
+
+
+def _dedupe_tokens(tokens: Iterable[str]) -> List[str]:
     seen = set()
     token_list: List[str] = []
     for token in tokens:
@@ -259,77 +530,107 @@ def send_notification(
             continue
         seen.add(token)
         token_list.append(token)
-    if not token_list:
-        raise ValueError("At least one token is required")
+    return token_list
+
 
+def _fan_out(
+    token_list: List[str],
+    title: str,
+    body: str,
+    data: Optional[Dict[str, Any]],
+    dry_run: bool,
+    capture_errors: bool,
+) -> List[Dict[str, Any]]:
     credentials, project_id, auth_request = _ensure_credentials_ready()
     endpoint_base = Config.FCM_API_URL.rstrip("/")
     url = f"{endpoint_base}/projects/{project_id}/messages:send"
 
-    total_success = 0
-    total_failure = 0
-    responses: List[Dict[str, Any]] = []
+    session = _http_session()
     payload_data = _normalize_data(data)
 
-    for token in token_list:
-        with _credentials_lock:
-            if not credentials.valid:
-                credentials.refresh(auth_request)
-            bearer_token = credentials.token
-
-        message_payload: Dict[str, Any] = {
-            "message": {
-                "token": token,
-                "notification": {
-                    "title": title,
-                    "body": body,
-                },
-                "data": payload_data.copy() if payload_data else {},
-            }
-        }
-        if dry_run:
-            message_payload["validate_only"] = True
-
-        headers = {
-            "Authorization": f"Bearer {bearer_token}",
-            "Content-Type": "application/json; charset=UTF-8",
-        }
+    def send(token: str) -> Dict[str, Any]:
+        return _send_one(
+            session, url, token, title, body, payload_data, dry_run,
+            credentials, auth_request, capture_errors,
+        )
 
+    workers = min(max(1, Config.FCM_MAX_WORKERS), len(token_list))
+    if workers == 1:
+        return [send(token) for token in token_list]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fcm-send") as pool:
+        futures = [pool.submit(send, token) for token in token_list]
         try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json=message_payload,
-                timeout=Config.FCM_TIMEOUT_SECONDS,
-            )
-        except requests.RequestException as exc:
-            raise NotificationSendError(f"Failed to reach FCM: {exc}") from exc
+            return [future.result() for future in futures]
+        except NotificationSendError:
+            for future in futures:
+                future.cancel()
+            raise
 
-        try:
-            response_json = response.json()
-        except ValueError:
-            response_json = {"raw": response.text}
-
-        is_success = response.status_code == 200
-        if is_success:
-            total_success += 1
-        else:
-            total_failure += 1
-
-        responses.append(
-            {
-                "status_code": response.status_code,
-                "success": 1 if is_success else 0,
-                "failure": 0 if is_success else 1,
-                "token": token,
-                "response": response_json,
-            }
-        )
 
+def ensure_credentials() -> None:
+    """Raise NotificationSendError now if FCM credentials are unusable."""
+    _ensure_credentials_ready()
+
+
+def deliver(
+    tokens: Iterable[str],
+    title: str,
+    body: str,
+    data: Optional[Dict[str, Any]] = None,
+    dry_run: bool = False,
+) -> List[Dict[str, Any]]:
+    """Send to each token and return one response per token, in order.
+
+    Unlike send_notification(), transport failures do not abort the batch:
+    they come back as a failed response with status_code None. Used by the
+    background job queue, which decides per token whether to retry.
+    """
+    token_list = _dedupe_tokens(tokens)
+    if not token_list:
+        return []
+    return _fan_out(token_list, title, body, data, dry_run, capture_errors=True)
+
+
+def earthquake_alert(
+    earthquake_id: str,
+    latitude: float,
+    longitude: float,
+    magnitude: float,
+    depth_km: Optional[float] = None,
+    source: str = "detected",
+) -> Tuple[str, str, Dict[str, Any]]:
+    """Default (title, body, data) of the alert sent for an earthquake."""
+    title = f"Simulated {source} earthquake" if source != "detected" else "Detected earthquake"
+    body = f"M{magnitude:.1f} event near ({latitude:.3f}, {longitude:.3f})."
+    data: Dict[str, Any] = {
+        "earthquake_id": earthquake_id,
+        "magnitude": f"{magnitude:.2f}",
+        "source": source,
+        "latitude": f"{latitude:.5f}",
+        "longitude": f"{longitude:.5f}",
+    }
+    if depth_km is not None:
+        data["depth"] = f"{depth_km:.1f}"
+    return title, body, data
+
+
+def send_notification(
+    tokens: Iterable[str],
+    title: str,
+    body: str,
+    data: Optional[Dict[str, Any]] = None,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    token_list = _dedupe_tokens(tokens)
+    if not token_list:
+        raise ValueError("At least one token is required")
+
+    responses = _fan_out(token_list, title, body, data, dry_run, capture_errors=False)
+    total_success = sum(response["success"] for response in responses)
     return {
         "requested_tokens": token_list,
         "success": total_success,
-        "failure": total_failure,
+        "failure": len(responses) - total_success,
         "responses": responses,
         "dry_run": dry_run,
     }
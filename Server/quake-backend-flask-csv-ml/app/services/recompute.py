@@ -0,0 +1,171 @@
+"""Background recompute of the expected-earthquake predictions.
+
+POST /api/earthquakes/expected/recompute starts a job and returns at once;
+a daemon thread predicts the detected catalogue RECOMPUTE_CHUNK_ROWS rows
+at a time, verifies each chunk against the detected events
+(services.verification) and writes it to a temp file that replaces
+OUTPUT_PREDICTIONS_CSV only when every chunk succeeded (with
+INCREMENTAL_PREDICTIONS the prediction store is upserted instead).
+
+Jobs live in the SQLite database shared by the workers (DEVICE_TOKENS_DB),
+so any process can report a job's progress, and a request made while a job
+is running in any process joins that job instead of starting another. A
+running job whose process is gone (checked directly on the same host, else
+by no progress for RECOMPUTE_STALE_SECONDS) is marked failed and no longer
+blocks new ones.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from config import Config
+from . import catalog, csvio, ml, token_store, verification
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recompute_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    owner TEXT,
+    total INTEGER,
+    processed INTEGER NOT NULL DEFAULT 0,
+    predicted INTEGER,
+    rows INTEGER,
+    path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS recompute_jobs_status ON recompute_jobs (status, updated_at);
+"""
+
+RUNNING, DONE, FAILED = "running", "done", "failed"
+
+log = logging.getLogger(__name__)
+
+_init_lock = threading.Lock()
+_initialized: set = set()
+
+
+def ensure_storage() -> None:
+    token_store.initialize()
+    path = Config.DEVICE_TOKENS_DB
+    with _init_lock:
+        if path in _initialized:
+            return
+        token_store.connection().executescript(_SCHEMA)
+        _initialized.add(path)
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner: Optional[str]) -> bool:
+    """False only when the owner is a process on this host that no longer exists."""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def start() -> Tuple[Dict[str, Any], bool]:
+    """(job status, started): the running job if there is one, else a new one."""
+    ensure_storage()
+    now = time.time()
+    with token_store.write_transaction() as txn:
+        conn = txn.conn
+        job_id = None
+        for row in conn.execute(
+            "SELECT id, owner, updated_at FROM recompute_jobs WHERE status = ? ORDER BY created_at DESC", (RUNNING,)
+        ).fetchall():
+            if row["updated_at"] < now - Config.RECOMPUTE_STALE_SECONDS or not _owner_alive(row["owner"]):
+                conn.execute(
+                    "UPDATE recompute_jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                    (FAILED, "abandoned (worker process exited)", now, row["id"]),
+                )
+            elif job_id is None:
+                job_id = row["id"]
+        started = job_id is None
+        if started:
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO recompute_jobs (id, status, mode, owner, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, RUNNING, "incremental" if Config.INCREMENTAL_PREDICTIONS else "full", _owner(), now, now),
+            )
+    if started:
+        threading.Thread(target=_run, args=(job_id,), name=f"recompute-{job_id[:8]}", daemon=True).start()
+    return job_status(job_id), started
+
+
+def _update(job_id: str, **fields: Any) -> None:
+    fields["updated_at"] = time.time()
+    if fields.get("status") in (DONE, FAILED):
+        fields["finished_at"] = fields["updated_at"]
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with token_store.write_transaction() as txn:
+        txn.conn.execute(f"UPDATE recompute_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def _run(job_id: str) -> None:
+    try:
+        ml.clear_prediction_cache()
+        _, api_df = csvio.api_earthquakes_snapshot()
+        if Config.INCREMENTAL_PREDICTIONS:
+            result = ml.predict_incremental(
+                api_df, progress=lambda done, total: _update(job_id, processed=done, total=total)
+            )
+            if result is None:
+                raise RuntimeError("Models or scalers not found")
+            pred_df, predicted = result
+            _update(
+                job_id, status=DONE, total=predicted, processed=predicted, predicted=predicted,
+                rows=len(pred_df), path=Config.PREDICTIONS_STORE_CSV,
+            )
+            return
+
+        _update(job_id, total=len(api_df))
+        chunks = ml.iter_predictions(api_df)
+        if chunks is None:
+            raise RuntimeError("Models or scalers not found")
+        detected = catalog.detected_dataset()
+        processed = 0
+        with csvio.predictions_out_writer() as write:
+            for chunk in chunks:
+                write(verification.verify(chunk, detected))
+                processed += len(chunk)
+                _update(job_id, processed=processed)
+        _update(job_id, status=DONE, predicted=processed, rows=processed, path=Config.OUTPUT_PREDICTIONS_CSV)
+    except Exception as exc:
+        log.exception("recompute job %s failed", job_id)
+        _update(job_id, status=FAILED, error=f"{type(exc).__name__}: {exc}")
+
+
+def job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    ensure_storage()
+    job = token_store.connection().execute("SELECT * FROM recompute_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return None
+    status = dict(job)
+    # the four targets run as one fused call per chunk, so they advance together
+    status["progress"] = {t: job["processed"] for t in ml.TARGETS}
+    return status
+
+
+def latest_job() -> Optional[Dict[str, Any]]:
+    ensure_storage()
+    row = token_store.connection().execute(
+        "SELECT id FROM recompute_jobs ORDER BY created_at DESC LIMIT 1"
+    ).fetchone()
+    return None if row is None else job_status(row["id"])
@@ -0,0 +1,109 @@
+"""Spatial helpers: vectorized great-circle distance and a lat/lon grid index."""
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; accepts scalars or NumPy arrays (broadcast)."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+class GridIndex:
+    """Uniform lat/lon grid over a set of points, stored in CSR form.
+
+    Point positions are sorted by cell id, so every run of adjacent cells in a
+    grid row maps to one contiguous slice. Queries collect candidate slices per
+    grid row and then run the exact predicate on the candidates only. Positions
+    returned by queries are sorted ascending (i.e. in dataset order).
+    """
+
+    def __init__(self, lat, lon, cell_deg: float = 1.0):
+        self.cell_deg = float(cell_deg)
+        self.nrows = int(math.ceil(180.0 / self.cell_deg))
+        self.ncols = int(math.ceil(360.0 / self.cell_deg))
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        valid = np.flatnonzero(np.isfinite(self.lat) & np.isfinite(self.lon))
+        cell_ids = self._row(self.lat[valid]) * self.ncols + self._col(self.lon[valid])
+        order = np.argsort(cell_ids, kind="stable")
+        self._positions = valid[order]
+        self._starts = np.searchsorted(cell_ids[order], np.arange(self.nrows * self.ncols + 1))
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90.0) / self.cell_deg), 0, self.nrows - 1).astype(np.int64)
+
+    def _col(self, lon):
+        return np.clip(np.floor((np.asarray(lon) + 180.0) / self.cell_deg), 0, self.ncols - 1).astype(np.int64)
+
+    def _candidates(self, south: float, north: float, lon_ranges: List[Tuple[float, float]]) -> np.ndarray:
+        row0, row1 = int(self._row(south)), int(self._row(north))
+        chunks = []
+        for west, east in lon_ranges:
+            col0, col1 = int(self._col(west)), int(self._col(east))
+            for row in range(row0, row1 + 1):
+                base = row * self.ncols
+                start, stop = self._starts[base + col0], self._starts[base + col1 + 1]
+                if stop > start:
+                    chunks.append(self._positions[start:stop])
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(chunks))
+
+    def query_bbox(self, west: float, south: float, east: float, north: float) -> np.ndarray:
+        """Positions with south <= lat <= north and west <= lon <= east."""
+        if not (south <= north and west <= east):  # also rejects NaN bounds
+            return np.empty(0, dtype=np.int64)
+        cand = self._candidates(south, north, [(west, east)])
+        lat, lon = self.lat[cand], self.lon[cand]
+        return cand[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+
+    def query_radius(self, lat: float, lon: float, radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """(positions, distances_km) of points within radius_km of (lat, lon)."""
+        if radius_km < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+        d_lat = radius_km / KM_PER_DEGREE
+        south, north = lat - d_lat, lat + d_lat
+        lon_ranges = circle_lon_ranges(lon, south, north, d_lat)
+        cand = self._candidates(max(south, -90.0), min(north, 90.0), lon_ranges)
+        dist = haversine_km(lat, lon, self.lat[cand], self.lon[cand])
+        keep = dist <= radius_km
+        return cand[keep], dist[keep]
+
+def circle_lon_ranges(lon: float, south: float, north: float, d_lat: float) -> List[Tuple[float, float]]:
+    """Longitude span of a circle's bounding box; splits ranges crossing the antimeridian."""
+    if south <= -90.0 or north >= 90.0:
+        return [(-180.0, 180.0)]
+    widest = math.cos(math.radians(max(abs(south), abs(north))))
+    d_lon = d_lat / widest if widest > 1e-12 else 360.0
+    if d_lon >= 180.0:
+        return [(-180.0, 180.0)]
+    west, east = lon - d_lon, lon + d_lon
+    ranges = [(max(west, -180.0), min(east, 180.0))]
+    if west < -180.0:
+        ranges.append((west + 360.0, 180.0))
+    if east > 180.0:
+        ranges.append((-180.0, east - 360.0))
+    return ranges
+
+def parse_radius_query(args) -> Optional[Tuple[float, float, float]]:
+    """(lat, lon, radius_km) from the querystring, or None if absent/invalid."""
+    try:
+        lat = float(args.get("lat"))
+        lon = float(args.get("lon"))
+        radius_km = float(args.get("radius_km"))
+    except (TypeError, ValueError):
+        return None
+    if not all(math.isfinite(v) for v in (lat, lon, radius_km)):
+        return None
+    return lat, lon, radius_km
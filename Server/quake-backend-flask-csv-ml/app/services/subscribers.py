@@ -0,0 +1,105 @@
+"""Geospatial index of alert subscribers.
+
+Each subscriber's alert circle (preference location + radius_km) is
+registered in every grid cell its bounding box overlaps, so matching an
+event is a single cell lookup followed by a vectorized haversine over the
+candidates in that cell. Subscribers whose circle would span too many cells
+(very large radii) live in a small "global" bucket checked for every event.
+Updates are incremental (upsert/remove per token). Not thread-safe: callers
+serialize access (see services.notifications).
+"""
+import math
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .spatial import KM_PER_DEGREE, circle_lon_ranges, haversine_km
+
+Cell = Tuple[int, int]
+
+class SubscriberIndex:
+    def __init__(self, cell_deg: float = 1.0, max_cells: int = 4096):
+        self.cell_deg = float(cell_deg)
+        self.nrows = int(math.ceil(180.0 / self.cell_deg))
+        self.ncols = int(math.ceil(360.0 / self.cell_deg))
+        self.max_cells = max_cells
+        # token -> (latitude, longitude, radius_km, minimum_magnitude)
+        self._prefs: Dict[str, Tuple[float, float, float, float]] = {}
+        self._min_magnitude_raw: Dict[str, Optional[float]] = {}
+        self._cells: Dict[Cell, Set[str]] = {}
+        self._token_cells: Dict[str, List[Cell]] = {}
+        self._global: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._prefs)
+
+    def _row(self, lat: float) -> int:
+        return min(max(int(math.floor((lat + 90.0) / self.cell_deg)), 0), self.nrows - 1)
+
+    def _col(self, lon: float) -> int:
+        return min(max(int(math.floor((lon + 180.0) / self.cell_deg)), 0), self.ncols - 1)
+
+    def _covered_cells(self, lat: float, lon: float, radius_km: float) -> Optional[List[Cell]]:
+        d_lat = radius_km / KM_PER_DEGREE
+        south, north = lat - d_lat, lat + d_lat
+        rows = range(self._row(max(south, -90.0)), self._row(min(north, 90.0)) + 1)
+        cols: List[int] = []
+        for west, east in circle_lon_ranges(lon, south, north, d_lat):
+            cols.extend(range(self._col(west), self._col(east) + 1))
+        if len(rows) * len(cols) > self.max_cells:
+            return None
+        return [(row, col) for row in rows for col in cols]
+
+    def remove(self, token: str) -> None:
+        self._prefs.pop(token, None)
+        self._min_magnitude_raw.pop(token, None)
+        self._global.discard(token)
+        for cell in self._token_cells.pop(token, []):
+            bucket = self._cells.get(cell)
+            if bucket is not None:
+                bucket.discard(token)
+                if not bucket:
+                    del self._cells[cell]
+
+    def upsert(self, token: str, preferences: Optional[dict]) -> None:
+        """Indexes (or re-indexes) a token; incomplete preferences just remove it."""
+        self.remove(token)
+        prefs = preferences or {}
+        try:
+            lat = float(prefs["latitude"])
+            lon = float(prefs["longitude"])
+            radius_km = float(prefs["radius_km"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if not all(math.isfinite(v) for v in (lat, lon, radius_km)) or radius_km < 0:
+            return
+        min_magnitude = float(prefs.get("minimum_magnitude") or 0.0)
+        self._prefs[token] = (lat, lon, radius_km, min_magnitude)
+        self._min_magnitude_raw[token] = prefs.get("minimum_magnitude", 0.0)
+        cells = self._covered_cells(lat, lon, radius_km)
+        if cells is None:
+            self._global.add(token)
+            return
+        self._token_cells[token] = cells
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(token)
+
+    def match(self, latitude: float, longitude: float, magnitude: float) -> List[dict]:
+        """Subscribers whose circle contains the event and whose minimum magnitude it meets, nearest first."""
+        candidates = list(self._cells.get((self._row(latitude), self._col(longitude)), ()))
+        candidates.extend(self._global)
+        if not candidates:
+            return []
+        prefs = np.array([self._prefs[token] for token in candidates], dtype=float).reshape(-1, 4)
+        distances = haversine_km(prefs[:, 0], prefs[:, 1], latitude, longitude)
+        hits = np.flatnonzero((distances <= prefs[:, 2]) & (magnitude >= prefs[:, 3]))
+        hits = hits[np.argsort(distances[hits], kind="stable")]
+        return [
+            {
+                "token": candidates[i],
+                "distance_km": float(distances[i]),
+                "radius_km": float(prefs[i, 2]),
+                "min_magnitude": self._min_magnitude_raw[candidates[i]],
+            }
+            for i in hits
+        ]
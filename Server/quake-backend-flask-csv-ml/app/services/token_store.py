@@ -0,0 +1,320 @@
+"""SQLite storage for FCM device tokens.
+
+One row per token, written with per-row upserts inside short
+``BEGIN IMMEDIATE`` transactions. The database runs in WAL mode, so readers
+never block writers and a crash mid-write leaves the previous committed
+state intact. A ``generation`` counter in the ``meta`` table is bumped by
+every write so in-memory mirrors (see services.notifications) can tell
+whether they are still current.
+
+Entries keep the dict shape of the former ``device_tokens.json`` entries;
+an existing JSON file is imported once when the database is created.
+Delivery history is kept in its own ``deliveries`` table (unique on
+token + earthquake_id) rather than as a list on the device row.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+
+_COLUMNS = (
+    "token", "created_at", "updated_at", "metadata", "preferences", "delivered_ids",
+    "deactivated_at", "deactivated_reason", "last_seen_at",
+)
+_JSON_COLUMNS = ("metadata", "preferences", "delivered_ids")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    token TEXT PRIMARY KEY,
+    created_at INTEGER,
+    updated_at INTEGER,
+    metadata TEXT,
+    preferences TEXT,
+    delivered_ids TEXT,
+    extra TEXT,
+    deactivated_at INTEGER,
+    deactivated_reason TEXT,
+    last_seen_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    seq INTEGER PRIMARY KEY,
+    token TEXT NOT NULL,
+    earthquake_id TEXT NOT NULL,
+    delivered_at INTEGER,
+    UNIQUE (token, earthquake_id)
+);
+CREATE INDEX IF NOT EXISTS deliveries_earthquake ON deliveries (earthquake_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+_ROW_COLUMNS = (
+    "token", "created_at", "updated_at", "metadata", "preferences", "delivered_ids",
+    "extra", "deactivated_at", "deactivated_reason", "last_seen_at",
+)
+_INSERT_SQL = (
+    f"INSERT INTO devices ({', '.join(_ROW_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in _ROW_COLUMNS)})"
+)
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized: set = set()
+
+
+def _db_path() -> str:
+    return Config.DEVICE_TOKENS_DB
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def connection() -> sqlite3.Connection:
+    """Thread-local connection to the configured database (schema ensured)."""
+    path = _db_path()
+    cached = getattr(_local, "conn", None)
+    if cached is not None and cached[0] == path:
+        return cached[1]
+    initialize()
+    conn = _open(path)
+    _local.conn = (path, conn)
+    return conn
+
+
+def initialize() -> None:
+    """Create the database/schema and import the legacy JSON file once."""
+    path = _db_path()
+    with _init_lock:
+        if path in _initialized:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = _open(path)
+        try:
+            conn.executescript(_SCHEMA)
+            add_missing_columns(conn, "devices", {
+                "deactivated_at": "INTEGER",
+                "deactivated_reason": "TEXT",
+            })
+            _add_last_seen(conn)
+            _import_legacy_json(conn)
+            _migrate_delivered_ids(conn)
+        finally:
+            conn.close()
+        _initialized.add(path)
+
+
+def add_missing_columns(conn: sqlite3.Connection, table: str, columns: Dict[str, str]) -> None:
+    """ALTER TABLE ADD COLUMN for columns added after the table was created."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _add_last_seen(conn: sqlite3.Connection) -> None:
+    """Add last_seen_at, seeded from updated_at (the best guess available)."""
+    if "last_seen_at" in {row[1] for row in conn.execute("PRAGMA table_info(devices)")}:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        add_missing_columns(conn, "devices", {"last_seen_at": "INTEGER"})
+        conn.execute("UPDATE devices SET last_seen_at = updated_at")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _import_legacy_json(conn: sqlite3.Connection) -> None:
+    legacy = Config.DEVICE_TOKENS_JSON
+    if not legacy or not os.path.exists(legacy):
+        return
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+        return
+    try:
+        with open(legacy, "r", encoding="utf-8") as handle:
+            data = json.load(handle)
+    except (json.JSONDecodeError, OSError):
+        data = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for entry in data if isinstance(data, list) else []:
+            if isinstance(entry, dict) and entry.get("token"):
+                # legacy files predate last_seen_at; updated_at is the best guess
+                entry.setdefault("last_seen_at", entry.get("updated_at"))
+                conn.execute(
+                    _INSERT_SQL.replace("INSERT", "INSERT OR IGNORE", 1),
+                    _entry_to_row(entry),
+                )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_json_imported', 1)")
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _migrate_delivered_ids(conn: sqlite3.Connection) -> None:
+    """Move delivered_ids lists still stored on device rows into deliveries."""
+    rows = conn.execute(
+        "SELECT token, updated_at, delivered_ids FROM devices WHERE delivered_ids IS NOT NULL ORDER BY rowid"
+    ).fetchall()
+    if not rows:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for row in rows:
+            conn.executemany(
+                "INSERT OR IGNORE INTO deliveries (token, earthquake_id, delivered_at) VALUES (?, ?, ?)",
+                [(row["token"], str(eq_id), row["updated_at"]) for eq_id in json.loads(row["delivered_ids"]) or []],
+            )
+        conn.execute("UPDATE devices SET delivered_ids = NULL")
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _dumps(value: Any) -> Optional[str]:
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+
+def _entry_to_row(entry: Dict[str, Any]) -> tuple:
+    extra = {k: v for k, v in entry.items() if k not in _COLUMNS}
+    return (
+        entry["token"],
+        entry.get("created_at"),
+        entry.get("updated_at"),
+        _dumps(entry.get("metadata")),
+        _dumps(entry.get("preferences")),
+        None,  # delivered_ids live in the deliveries table
+        _dumps(extra) if extra else None,
+        entry.get("deactivated_at"),
+        entry.get("deactivated_reason"),
+        entry.get("last_seen_at"),
+    )
+
+
+def _row_to_entry(row: sqlite3.Row) -> Dict[str, Any]:
+    entry: Dict[str, Any] = {"token": row["token"]}
+    for key in ("created_at", "updated_at", "deactivated_at", "deactivated_reason", "last_seen_at"):
+        if row[key] is not None:
+            entry[key] = row[key]
+    for key in _JSON_COLUMNS:
+        if row[key] is not None:
+            entry[key] = json.loads(row[key])
+    if row["extra"]:
+        entry.update(json.loads(row["extra"]))
+    return entry
+
+
+class Transaction:
+    """Handle yielded by write_transaction(); `generation` is (before, after) once committed."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.dirty = False
+        self.generation = None
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT * FROM devices WHERE token = ?", (token,)).fetchone()
+        return _row_to_entry(row) if row else None
+
+    def add_deliveries(
+        self, token: str, earthquake_ids: List[str], max_history: int, now: int
+    ) -> Tuple[List[str], List[str]]:
+        """Record deliveries for token, keeping only its newest max_history.
+
+        Returns (added, evicted) earthquake ids; ids already recorded are skipped.
+        """
+        added = []
+        for earthquake_id in earthquake_ids:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO deliveries (token, earthquake_id, delivered_at) VALUES (?, ?, ?)",
+                (token, earthquake_id, now),
+            )
+            if cursor.rowcount:
+                added.append(earthquake_id)
+        if not added:
+            return added, []
+        evicted = self.conn.execute(
+            "SELECT seq, earthquake_id FROM deliveries WHERE token = ? ORDER BY seq DESC LIMIT -1 OFFSET ?",
+            (token, max_history),
+        ).fetchall()
+        if evicted:
+            self.conn.executemany("DELETE FROM deliveries WHERE seq = ?", [(row["seq"],) for row in evicted])
+        self.dirty = True
+        return added, [row["earthquake_id"] for row in reversed(evicted)]
+
+    def put(self, entry: Dict[str, Any]) -> None:
+        self.conn.execute(
+            _INSERT_SQL + " ON CONFLICT(token) DO UPDATE SET "
+            + ", ".join(f"{name} = excluded.{name}" for name in _ROW_COLUMNS[1:]),
+            _entry_to_row(entry),
+        )
+        self.dirty = True
+
+
+@contextmanager
+def write_transaction() -> Iterator[Transaction]:
+    """Serializable write transaction; bumps the generation if anything was written."""
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    txn = Transaction(conn)
+    try:
+        yield txn
+        before = generation(conn)
+        if txn.dirty:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        conn.execute("COMMIT")
+        txn.generation = (before, before + 1 if txn.dirty else before)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def generation(conn: Optional[sqlite3.Connection] = None) -> int:
+    conn = conn or connection()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    return int(row["value"]) if row else 0
+
+
+def load_entries() -> Dict[str, Dict[str, Any]]:
+    """All entries keyed by token, in registration order."""
+    return snapshot()[1]
+
+
+def snapshot() -> Tuple[int, Dict[str, Dict[str, Any]]]:
+    """(generation, entries) read from a single consistent view.
+
+    Each entry's delivered_ids lists its recorded deliveries, oldest first.
+    """
+    conn = connection()
+    conn.execute("BEGIN")
+    try:
+        current = generation(conn)
+        rows = conn.execute("SELECT * FROM devices ORDER BY rowid").fetchall()
+        deliveries = conn.execute("SELECT token, earthquake_id FROM deliveries ORDER BY seq").fetchall()
+    finally:
+        conn.execute("COMMIT")
+    entries = {row["token"]: _row_to_entry(row) for row in rows}
+    for row in deliveries:
+        entry = entries.get(row["token"])
+        if entry is not None:
+            entry.setdefault("delivered_ids", []).append(row["earthquake_id"])
+    return current, entries
+
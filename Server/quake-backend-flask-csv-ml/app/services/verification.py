@@ -0,0 +1,324 @@
+"""Verification of predictions against detected earthquakes.
+
+A prediction counts as correct when a detected event other than the one it
+was predicted from lies within VERIFY_DISTANCE_KM of its predicted
+position, VERIFY_TIME_TOLERANCE_HOURS of its predicted time and
+VERIFY_MAGNITUDE_TOLERANCE of its predicted magnitude. The nearest such
+event becomes its predicted_earthquake_id.
+
+Matching is vectorized over a spatio-temporal index of the detected events
+(EventIndex): each prediction's candidates are nine contiguous slices of
+the index, the slices are expanded into (prediction, event) pairs in blocks
+of at most VERIFY_MAX_PAIRS, and cheap magnitude, source-id and
+chord-distance checks pick the nearest event, whose exact haversine
+distance is computed last.
+"""
+import math
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from . import catalog
+from .spatial import EARTH_RADIUS_KM, KM_PER_DEGREE, haversine_km
+
+# smallest cell size, which keeps cell * span within int64 for centuries of events
+_MIN_BAND_DEG = 0.25
+_NAT_MS = np.iinfo(np.int64).min // 10**6
+
+_lock = threading.Lock()
+_index_memo: Dict[str, Any] = {}
+_stats_memo: Dict[str, Any] = {}
+
+
+def _tolerances() -> Dict[str, float]:
+    return {
+        "distance_km": Config.VERIFY_DISTANCE_KM,
+        "time_hours": Config.VERIFY_TIME_TOLERANCE_HOURS,
+        "magnitude": Config.VERIFY_MAGNITUDE_TOLERANCE,
+    }
+
+
+def _column(pred_df: pd.DataFrame, name: str) -> np.ndarray:
+    if name not in pred_df.columns:
+        return np.full(len(pred_df), np.nan)
+    return pd.to_numeric(pred_df[name], errors="coerce").to_numpy(dtype=float)
+
+
+def _time_ms(pred_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """(epoch ms, valid mask) of predicted_time."""
+    if "predicted_time" not in pred_df.columns:
+        return np.zeros(len(pred_df), dtype="int64"), np.zeros(len(pred_df), dtype=bool)
+    times = pd.to_datetime(pred_df["predicted_time"], errors="coerce")
+    valid = times.notna().to_numpy()
+    return times.astype("int64").to_numpy() // 10**6, valid
+
+
+def _unit_vectors(lat: np.ndarray, lon: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    phi, lam = np.radians(lat), np.radians(lon)
+    return np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)
+
+
+class EventIndex:
+    """Detected events sorted by (spatial cell, time).
+
+    Cells are one tolerance distance high (latitude bands) and, per band, at
+    least as wide as the longitude a VERIFY_DISTANCE_KM circle can span in it
+    or its neighbours. The events within the distance and
+    VERIFY_TIME_TOLERANCE_HOURS of a point therefore all lie in its 3 x 3
+    surrounding cells, and in each cell they form one contiguous slice found
+    by a binary search on the composite (cell, time) key.
+    """
+
+    def __init__(self, detected: catalog.Dataset):
+        self.distance_km = Config.VERIFY_DISTANCE_KM
+        self.tolerance_ms = int(Config.VERIFY_TIME_TOLERANCE_HOURS * 3_600_000)
+        self.magnitude = Config.VERIFY_MAGNITUDE_TOLERANCE
+        self.band_deg = max(self.distance_km / KM_PER_DEGREE, _MIN_BAND_DEG)
+        self.nbands = int(math.ceil(180.0 / self.band_deg))
+        # widest |lat| a point in a band or an adjacent one can have
+        edges = np.abs(-90.0 + self.band_deg * np.arange(-1, self.nbands + 3))
+        reach = np.minimum(np.maximum(edges[:-3], edges[3:]), 90.0)
+        # largest longitude difference two points that close can have at that latitude
+        ratio = math.sin(self.distance_km / EARTH_RADIUS_KM / 2) / np.maximum(np.cos(np.radians(reach)), 1e-12)
+        span_deg = np.where(ratio < 1.0, np.degrees(2 * np.arcsin(np.minimum(ratio, 1.0))), 360.0)
+        ncols = np.floor(360.0 / np.maximum(span_deg, 1e-9)).astype(np.int64)
+        self.ncols = np.where(ncols < 3, 1, np.minimum(ncols, int(360.0 / _MIN_BAND_DEG)))
+        self.first_cell = np.r_[0, np.cumsum(self.ncols)[:-1]]
+
+        lat, lon, mag = detected.numeric("latitude"), detected.numeric("longitude"), detected.numeric("magnitude")
+        time_ms = detected.time_ms
+        valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(mag) & (time_ms != _NAT_MS)
+        positions = np.flatnonzero(valid)
+        self.t0 = int(time_ms[positions].min()) if len(positions) else 0
+        # cell-major key; every time offset fits in the span, so cells never overlap
+        self.span = (int(time_ms[positions].max()) - self.t0 + 1) if len(positions) else 1
+        bands = self._band(lat[positions])
+        cells = self.first_cell[bands] + self._col(bands, lon[positions])
+        key = cells * self.span + (time_ms[positions] - self.t0)
+        order = np.argsort(key, kind="stable")
+        self.key = key[order]
+        # [start, stop) of every cell, so empty cells need no search
+        self.cell_bounds = np.searchsorted(self.key, np.arange(int(self.ncols.sum()) + 1) * self.span)
+        self.positions = positions[order]
+        self.rank = np.empty(len(detected), dtype=np.int64)
+        self.rank[self.positions] = np.arange(len(self.positions))
+        self.lat, self.lon, self.mag = lat[self.positions], lon[self.positions], mag[self.positions]
+        self.time_ms = time_ms[self.positions]
+        self.xyz = _unit_vectors(self.lat, self.lon)
+        # squared chord between unit vectors, monotonic in great-circle distance
+        self.max_chord2 = (2 * math.sin(min(self.distance_km / EARTH_RADIUS_KM, math.pi) / 2)) ** 2 * (1 + 1e-9)
+        codes, self.ids = pd.factorize(detected.frame["earthquake_id"].astype(object))
+        self.codes = codes[self.positions]
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def _band(self, lat: np.ndarray) -> np.ndarray:
+        return np.clip(np.floor((lat + 90.0) / self.band_deg), 0, self.nbands - 1).astype(np.int64)
+
+    def _col(self, bands: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        ncols = self.ncols[bands]
+        wrapped = np.mod(lon + 180.0, 360.0)
+        return np.minimum(np.floor(wrapped * ncols / 360.0).astype(np.int64), ncols - 1)
+
+    def windows(self, lat: np.ndarray, lon: np.ndarray, time_ms: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """([start], [stop)) slices into the sorted events, shape (len(lat), 9)."""
+        # visiting points in (cell, time) order keeps the searches below nearly
+        # sorted, which is several times faster than random binary searches
+        own = self._band(lat)
+        order = np.argsort((self.first_cell[own] + self._col(own, lon)) * self.span + (time_ms - self.t0), kind="stable")
+        lat, lon, time_ms = lat[order], lon[order], time_ms[order]
+        bands = self._band(lat)[:, None] + np.repeat(np.arange(-1, 2), 3)
+        cols = np.tile(np.arange(-1, 2), 3)
+        inside = (bands >= 0) & (bands < self.nbands)
+        bands = np.clip(bands, 0, self.nbands - 1)
+        ncols = self.ncols[bands]
+        # single-cell bands are scanned once, not three times
+        inside &= (ncols > 1) | (cols == 0)
+        cells = self.first_cell[bands] + np.mod(self._col(bands, lon[:, None]) + cols, ncols)
+        lo = np.broadcast_to((time_ms - self.tolerance_ms - self.t0)[:, None], cells.shape)
+        hi = np.broadcast_to((time_ms + self.tolerance_ms - self.t0)[:, None], cells.shape)
+        starts = self.cell_bounds[cells]
+        stops = self.cell_bounds[cells + 1]
+        search = inside & (stops > starts) & (hi >= 0) & (lo < self.span)
+        stops = np.where(search, stops, starts)
+        base = cells[search] * self.span
+        starts[search] = np.searchsorted(self.key, base + np.maximum(lo[search], 0), side="left")
+        stops[search] = np.searchsorted(self.key, base + np.minimum(hi[search], self.span - 1), side="right")
+        unsorted = np.empty_like(order)
+        unsorted[order] = np.arange(len(order))
+        return starts[unsorted], np.maximum(starts, stops)[unsorted]
+
+
+def event_index(detected: catalog.Dataset) -> EventIndex:
+    """EventIndex for detected, reused while the dataset and tolerances are unchanged."""
+    tolerances = _tolerances()
+    with _lock:
+        if _index_memo.get("detected") is detected and _index_memo.get("tolerances") == tolerances:
+            return _index_memo["index"]
+    index = EventIndex(detected)
+    with _lock:
+        _index_memo.update(detected=detected, tolerances=tolerances, index=index)
+    return index
+
+
+class _Matcher:
+    """Predictions of one match() call against an EventIndex."""
+
+    def __init__(self, pred_df: pd.DataFrame, index: EventIndex):
+        self.index = index
+        self.lat = _column(pred_df, "predicted_latitude")
+        self.lon = _column(pred_df, "predicted_longitude")
+        self.mag = _column(pred_df, "predicted_magnitude")
+        self.time_ms, valid = _time_ms(pred_df)
+        valid &= np.isfinite(self.lat) & np.isfinite(self.lon) & np.isfinite(self.mag)
+        self.xyz = _unit_vectors(self.lat, self.lon)
+        # -2 never equals an event's code (missing ids are -1), so no event is excluded
+        self.src_codes = np.full(len(pred_df), -2)
+        if "earthquake_id" in pred_df.columns:
+            codes = pd.Index(index.ids).get_indexer(pred_df["earthquake_id"].astype(object))
+            self.src_codes[codes >= 0] = codes[codes >= 0]
+        self.starts, stops = index.windows(np.where(valid, self.lat, 0.0), np.where(valid, self.lon, 0.0), self.time_ms)
+        self.counts = np.where(valid[:, None], stops - self.starts, 0)
+
+    def blocks(self):
+        """Consecutive prediction ranges expanding to at most VERIFY_MAX_PAIRS candidates each."""
+        ends = np.cumsum(self.counts.sum(axis=1))
+        limit = max(1, Config.VERIFY_MAX_PAIRS)
+        start = 0
+        while start < len(ends):
+            base = ends[start - 1] if start else 0
+            stop = min(len(ends), max(int(np.searchsorted(ends, base + limit, side="right")), start + 1))
+            yield np.arange(start, stop)
+            start = stop
+
+    def match_block(self, block: np.ndarray, result: Dict[str, np.ndarray]) -> None:
+        index = self.index
+        counts = self.counts[block].ravel()
+        total = int(counts.sum())
+        if total == 0:
+            return
+        pred = np.repeat(np.repeat(block, self.counts.shape[1]), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        event = np.repeat(self.starts[block].ravel(), counts) + offsets
+
+        # the windows already bound time; squared chords stand in for distances until the end
+        chord2 = np.zeros(total)
+        for axis in range(3):
+            chord2 += (index.xyz[axis][event] - self.xyz[axis][pred]) ** 2
+        keep = (
+            (chord2 <= index.max_chord2)
+            & (np.abs(index.mag[event] - self.mag[pred]) <= index.magnitude)
+            & (index.codes[event] != self.src_codes[pred])
+        )
+        pred, event, chord2 = pred[keep], event[keep], chord2[keep]
+        if not len(pred):
+            return
+
+        # pairs are grouped by prediction: nearest event per group, ties to the
+        # lower dataset position (the newer event)
+        first = np.flatnonzero(np.r_[True, pred[1:] != pred[:-1]])
+        sizes = np.diff(np.r_[first, len(pred)])
+        nearest = chord2 == np.repeat(np.minimum.reduceat(chord2, first), sizes)
+        position = np.where(nearest, index.positions[event], np.iinfo(np.int64).max)
+        pred, event = pred[first], index.rank[np.minimum.reduceat(position, first)]
+        dist = haversine_km(self.lat[pred], self.lon[pred], index.lat[event], index.lon[event])
+        keep = dist <= index.distance_km
+        pred, event, dist = pred[keep], event[keep], dist[keep]
+        result["position"][pred] = index.positions[event]
+        result["distance_km"][pred] = dist
+        result["time_offset_ms"][pred] = index.time_ms[event] - self.time_ms[pred]
+        result["magnitude_error"][pred] = index.mag[event] - self.mag[pred]
+
+
+def match(pred_df: pd.DataFrame, detected: catalog.Dataset) -> Dict[str, np.ndarray]:
+    """Nearest qualifying detected event per prediction row.
+
+    Returns arrays aligned to pred_df: "position" (row in detected.frame, -1 if
+    none), "distance_km", "time_offset_ms" (event minus predicted time) and
+    "magnitude_error" (NaN where unmatched).
+    """
+    rows = len(pred_df)
+    result = {
+        "position": np.full(rows, -1, dtype=np.int64),
+        "distance_km": np.full(rows, np.nan),
+        "time_offset_ms": np.full(rows, np.nan),
+        "magnitude_error": np.full(rows, np.nan),
+    }
+    index = event_index(detected)
+    if rows == 0 or len(index) == 0:
+        return result
+    matcher = _Matcher(pred_df, index)
+    for block in matcher.blocks():
+        matcher.match_block(block, result)
+    return result
+
+
+def verify(pred_df: pd.DataFrame, detected: Optional[catalog.Dataset] = None) -> pd.DataFrame:
+    """Copy of pred_df with predicted_earthquake_id / prediction_correct filled
+    against detected (default: the current detected catalogue)."""
+    detected = detected if detected is not None else catalog.detected_dataset()
+    found = match(pred_df, detected)["position"]
+    matched = found >= 0
+    ids = np.full(len(pred_df), None, dtype=object)
+    ids[matched] = detected.frame["earthquake_id"].to_numpy(dtype=object)[found[matched]]
+    out = pred_df.copy()
+    out["predicted_earthquake_id"] = ids
+    out["prediction_correct"] = matched
+    return out
+
+
+def accuracy_stats(pred_df: pd.DataFrame, detected: catalog.Dataset) -> Dict[str, Any]:
+    """Aggregate verification of pred_df against detected.
+
+    Only predictions whose tolerance window has closed (or that already
+    matched) are "evaluable": a prediction for the last few hours may still
+    be confirmed by events not detected yet.
+    """
+    found = match(pred_df, detected)
+    matched = found["position"] >= 0
+    time_ms, valid = _time_ms(pred_df)
+    evaluable = matched.copy()
+    if len(detected):
+        tolerance_ms = int(Config.VERIFY_TIME_TOLERANCE_HOURS * 3_600_000)
+        evaluable |= valid & (time_ms + tolerance_ms <= int(detected.time_ms.max()))
+    n_evaluable = int(evaluable.sum())
+    n_correct = int(matched.sum())
+
+    def mean(values):
+        return round(float(np.mean(values)), 3) if len(values) else None
+
+    return {
+        "predictions": int(len(pred_df)),
+        "evaluable": n_evaluable,
+        "pending": int(len(pred_df) - n_evaluable),
+        "correct": n_correct,
+        "accuracy": round(n_correct / n_evaluable, 4) if n_evaluable else None,
+        "mean_distance_km": mean(found["distance_km"][matched]),
+        "mean_abs_time_offset_minutes": mean(np.abs(found["time_offset_ms"][matched]) / 60_000),
+        "mean_abs_magnitude_error": mean(np.abs(found["magnitude_error"][matched])),
+        "tolerances": _tolerances(),
+    }
+
+
+def current_accuracy() -> Dict[str, Any]:
+    """accuracy_stats() for the served predictions, memoized until they, the
+    detected catalogue or the tolerances change."""
+    pred_df = catalog.expected_predictions()
+    detected = catalog.detected_dataset()
+    tolerances = _tolerances()
+    with _lock:
+        # both are cached upstream, so identity means "unchanged"
+        if (
+            _stats_memo.get("source") is pred_df
+            and _stats_memo.get("detected") is detected
+            and _stats_memo.get("tolerances") == tolerances
+        ):
+            return _stats_memo["stats"]
+    stats = accuracy_stats(pred_df, detected)
+    with _lock:
+        _stats_memo.update(source=pred_df, detected=detected, tolerances=tolerances, stats=stats)
+    return stats
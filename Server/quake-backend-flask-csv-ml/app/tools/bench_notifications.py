@@ -0,0 +1,143 @@
+"""End-to-end alert fan-out benchmark against the local FCM stand-in.
+
+Registers N synthetic devices (with alert preferences around a common
+point) in a throwaway token database, then measures through the Flask
+app:
+
+* ``POST /api/alerts/test-earthquake``: subscriber matching + enqueue time,
+  and the time until the job has sent to every matched device;
+* ``POST /api/alerts/notify/broadcast``: the same for every registered token.
+
+Run from the app directory::
+
+    python -m tools.bench_notifications --devices 5000 --latency-ms 40
+
+Stub options (latency, error/unregistered rates, --max-rps) are the same as
+``tools.fcm_stub``; pass --fcm-url to target an already running stub.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+from tools import fcm_stub
+
+
+def _configure_environment(args: argparse.Namespace, workdir: str) -> None:
+    # Must run before config is imported: Config reads the environment once.
+    if args.fcm_url:
+        fcm_url = args.fcm_url
+    else:
+        server = fcm_stub.serve(settings=fcm_stub.settings_from_args(args))
+        fcm_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.update({
+        "FCM_API_URL": fcm_url,
+        "FCM_ACCESS_TOKEN": "bench",
+        "FCM_PROJECT_ID": "bench",
+        "DEVICE_TOKENS_DB": os.path.join(workdir, "device_tokens.sqlite3"),
+        "DEVICE_TOKENS_JSON": os.path.join(workdir, "device_tokens.json"),
+        "ALERT_PIPELINE_ENABLED": "false",
+        "ALERT_JOB_POLL_SECONDS": "0.05",
+    })
+    if args.workers is not None:
+        os.environ["FCM_MAX_WORKERS"] = str(args.workers)
+
+
+def _register_devices(count: int, dead_fraction: float, center, seed: int) -> float:
+    from services import token_store
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    started = time.perf_counter()
+    with token_store.write_transaction() as txn:
+        for i in range(count):
+            prefix = "dead-" if rng.random() < dead_fraction else "dev-"
+            txn.put({
+                "token": f"{prefix}{i:07d}",
+                "created_at": now,
+                "updated_at": now,
+                "last_seen_at": now,
+                "preferences": {
+                    "latitude": center[0] + rng.uniform(-2.0, 2.0),
+                    "longitude": center[1] + rng.uniform(-2.0, 2.0),
+                    "radius_km": rng.choice([50.0, 100.0, 250.0, 500.0]),
+                    "minimum_magnitude": rng.choice([None, 3.0, 4.5]),
+                    "updated_at": now,
+                },
+            })
+    return time.perf_counter() - started
+
+
+def _wait_for_job(client, job_id: str, timeout: float) -> Dict[str, Any]:
+    deadline = time.perf_counter() + timeout
+    while True:
+        job = client.get(f"/api/alerts/jobs/{job_id}").get_json()["job"]
+        if job["status"] == "done" or time.perf_counter() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def _timed_job(client, path: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    started = time.perf_counter()
+    response = client.post(path, json=payload)
+    accepted = time.perf_counter() - started
+    body = response.get_json()
+    if response.status_code != 202:
+        return {"status_code": response.status_code, "error": body.get("error") or body.get("message")}
+    job = _wait_for_job(client, body["job"]["id"], timeout)
+    total = time.perf_counter() - started
+    return {
+        "accepted_ms": round(accepted * 1000, 2),
+        "total_s": round(total, 3),
+        "messages_per_s": round(job["total"] / total, 1) if total else None,
+        "matched": len(body.get("matches", [])) if "matches" in body else job["total"],
+        "status": job["status"],
+        "sent": job["sent"],
+        "failed": job["failed"],
+        "pending": job["pending"],
+        "pruned": job["pruned"],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--dead-fraction", type=float, default=0.05, help="share of devices the stub reports UNREGISTERED")
+    parser.add_argument("--magnitude", type=float, default=5.5)
+    parser.add_argument("--workers", type=int, default=None, help="override FCM_MAX_WORKERS")
+    parser.add_argument("--fcm-url", default=None, help="use a running stub instead of starting one")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for each job")
+    fcm_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    center = (-33.45, -70.66)
+    with tempfile.TemporaryDirectory(prefix="bench-notifications-") as workdir:
+        _configure_environment(args, workdir)
+        from app import create_app
+
+        client = create_app().test_client()
+        register_s = _register_devices(args.devices, args.dead_fraction, center, args.seed or 0)
+        results = {
+            "devices": args.devices,
+            "register_s": round(register_s, 3),
+            "test_earthquake": _timed_job(client, "/api/alerts/test-earthquake", {
+                "latitude": center[0],
+                "longitude": center[1],
+                "magnitude": args.magnitude,
+                "earthquakeId": "bench-1",
+            }, args.timeout),
+            "broadcast": _timed_job(client, "/api/alerts/notify/broadcast", {
+                "title": "Benchmark",
+                "body": "fan-out benchmark",
+            }, args.timeout),
+        }
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
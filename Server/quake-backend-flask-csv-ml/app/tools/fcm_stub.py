@@ -0,0 +1,195 @@
+"""Local stand-in for the FCM HTTP v1 send endpoint.
+
+Answers ``POST /v1/projects/<project>/messages:send`` the way FCM does,
+with configurable latency, transient 5xx errors, UNREGISTERED tokens and
+429 throttling, so notification fan-out can be exercised and measured
+without Google credentials. Point the backend at it with::
+
+    FCM_API_URL=http://127.0.0.1:9099/v1 FCM_ACCESS_TOKEN=local FCM_PROJECT_ID=local
+
+Run it standalone with::
+
+    python -m tools.fcm_stub --port 9099 --latency-ms 40 --error-rate 0.01
+
+``GET /stats`` returns the request counters.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+_SEND_PATH = re.compile(r"^/v1/projects/([^/]+)/messages:send$")
+_FCM_ERROR_TYPE = "type.googleapis.com/google.firebase.fcm.v1.FcmError"
+
+
+class StubSettings:
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        unregistered_rate: float = 0.0,
+        unregistered_prefix: str = "dead-",
+        max_rps: float = 0.0,
+        retry_after: int = 1,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.unregistered_rate = unregistered_rate
+        self.unregistered_prefix = unregistered_prefix
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {"requests": 0, "ok": 0, "unregistered": 0, "throttled": 0, "errors": 0}
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    def bump(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+
+    def admit(self, max_rps: float) -> bool:
+        """Fixed one-second window rate limit; False means answer 429."""
+        if max_rps <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            return self.window_count <= max_rps
+
+
+def _error(code: int, status: str, message: str, fcm_code: str) -> Dict[str, Any]:
+    return {
+        "error": {
+            "code": code,
+            "message": message,
+            "status": status,
+            "details": [{"@type": _FCM_ERROR_TYPE, "errorCode": fcm_code}],
+        }
+    }
+
+
+def _make_handler(settings: StubSettings, stats: _Stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with stats.lock:
+                    self._reply(200, dict(stats.counts))
+            else:
+                self._reply(404, {"error": {"code": 404, "status": "NOT_FOUND"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length)
+            match = _SEND_PATH.match(self.path)
+            if match is None:
+                self._reply(404, {"error": {"code": 404, "status": "NOT_FOUND"}})
+                return
+            stats.bump("requests")
+            if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+                self._reply(401, {"error": {"code": 401, "status": "UNAUTHENTICATED"}})
+                return
+            code, payload, headers = self._send(match.group(1), raw)
+            self._reply(code, payload, headers)
+
+        def _send(self, project: str, raw: bytes) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+            try:
+                token = json.loads(raw)["message"]["token"]
+            except (ValueError, KeyError, TypeError):
+                return 400, _error(400, "INVALID_ARGUMENT", "Invalid JSON payload", "INVALID_ARGUMENT"), {}
+
+            delay = settings.latency_ms + settings.random.uniform(0, settings.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+
+            if not stats.admit(settings.max_rps):
+                stats.bump("throttled")
+                return (
+                    429,
+                    _error(429, "RESOURCE_EXHAUSTED", "Quota exceeded", "QUOTA_EXCEEDED"),
+                    {"Retry-After": str(settings.retry_after)},
+                )
+            if token.startswith(settings.unregistered_prefix) or settings.random.random() < settings.unregistered_rate:
+                stats.bump("unregistered")
+                return 404, _error(404, "NOT_FOUND", "Requested entity was not found.", "UNREGISTERED"), {}
+            if settings.random.random() < settings.error_rate:
+                stats.bump("errors")
+                return 503, _error(503, "UNAVAILABLE", "The service is currently unavailable.", "UNAVAILABLE"), {}
+            stats.bump("ok")
+            return 200, {"name": f"projects/{project}/messages/{settings.random.getrandbits(63)}"}, {}
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 0, settings: Optional[StubSettings] = None) -> ThreadingHTTPServer:
+    """Start the stub on a daemon thread; port 0 picks a free port (see server_address)."""
+    server = ThreadingHTTPServer((host, port), _make_handler(settings or StubSettings(), _Stats()))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fcm-stub", daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fixed delay per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra uniform random delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 UNAVAILABLE answers")
+    parser.add_argument("--unregistered-rate", type=float, default=0.0, help="fraction of random UNREGISTERED answers")
+    parser.add_argument("--unregistered-prefix", default="dead-", help="tokens with this prefix are always UNREGISTERED")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="answer 429 above this many requests/second (0 = off)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def settings_from_args(args: argparse.Namespace) -> StubSettings:
+    return StubSettings(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        unregistered_rate=args.unregistered_rate,
+        unregistered_prefix=args.unregistered_prefix,
+        max_rps=args.max_rps,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9099)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(args.host, args.port, settings_from_args(args))
+    print(f"FCM stub listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()